@@ -18,6 +18,16 @@
 #   V = Overflow (set when operation overflow)
 #   C = Carry (set when was a cary from bit7)
 
+import ast
+import hashlib
+import inspect
+import marshal
+import os
+import sys
+import tempfile
+import textwrap
+import types
+
 from mypy_extensions import i16
 
 
@@ -27,12 +37,13 @@ class MC6800:
     # Software Interrupt Pointer     = 0xFFFF-5
     # Internal Interrupt Pointer     = 0xFFFF-7
 
-
+    stateNames = ["PC","A","B","IX","SP","SR","cycles"] # saved by Simulator.snapshot
 
     def __init__(self,fetchMemory=None,setMemory=None):
         self.fetchInstruction = fetchMemory # the same memory is shared between code and data
         self.fetchMemory = fetchMemory
         self.setMemory = setMemory
+        self.cycles = 0 # clock cycles executed since power on, see opcode.cycles
         if fetchMemory is not None:
             self.reset()
 
@@ -141,14 +152,12 @@ class MC6800:
         return self.SR & 0x08
         
     def step(self):
-        ops = list(filter(lambda x: x.code == self.fetchMemory(self.PC & 0xFFFF), opcodes))
-        op = ops[0] if ops else None
-        return op.execute(self) if op else False
+        op = dispatch[self.fetchMemory(self.PC & 0xFFFF)]
+        self.cycles += op.cycles
+        return op.execute(self)
 
     def getOpcode(self,index):
-        ops = list(filter(lambda x: x.code == self.fetchMemory(index), opcodes)) 
-        op = ops[0] if ops else None
-        return op,None
+        return dispatch[self.fetchMemory(index)],None
     
     def getRegisters(self):
         # status register SR highest two bits are always 11 H I N Z V C
@@ -156,12 +165,94 @@ class MC6800:
 
 
 
+
+#--- Lazy flags mode
+# The arithmetic operations (setFlagHNZVC/setFlagNZVC) only record their operands and result,
+# the flags are computed when SR is read (branches, TPA, pushes, interrupts, getRegisters)
+# and only for the flags no later instruction has overwritten in the meantime.
+# Same results as MC6800, SR is a property here so the mode is a separate class.
+class MC6800LazyFlags(MC6800):
+    flagMask = 0 # flags still to be computed from flagArgs
+    flagArgs = (0,0,0) # operands and result of the last arithmetic operation
+    sr = 0xC0
+
+    @property
+    def SR(self):
+        if self.flagMask:
+            self.materializeFlags()
+        return self.sr
+
+    @SR.setter
+    def SR(self,val):
+        self.flagMask = 0
+        self.sr = val
+
+    # computes the pending flags, same formulas as the MC6800 setFlag methods
+    def materializeFlags(self):
+        reg1in,reg2in,regOut = self.flagArgs
+        mask = self.flagMask
+        sr = self.sr & (0xFF ^ mask)
+        if mask & 0x01 and (regOut<0 or regOut>255):
+            sr |= 0x01
+        if mask & 0x02 and ((((reg1in & 0x80) == 0x80) & ((reg2in & 0x80) == 0x80) & ((regOut & 0x80) != 0x80))
+                            | (((reg1in & 0x80) != 0x80) & ((reg2in & 0x80) != 0x80) & ((regOut & 0x80) == 0x80))):
+            sr |= 0x02
+        if mask & 0x04 and regOut == 0:
+            sr |= 0x04
+        if mask & 0x08 and (regOut & 0x80) > 0:
+            sr |= 0x08
+        if mask & 0x20 and ((reg1in & reg2in ) | ((reg1in | reg2in) & (0xFF - regOut)) ) & 8 > 0:
+            sr |= 0x20
+        self.sr = sr
+        self.flagMask = 0
+
+    def setFlagHNZVC(self,reg1in,reg2in,regOut):
+        self.flagArgs = (reg1in,reg2in,regOut)
+        self.flagMask = 0x2F
+
+    def setFlagNZVC(self,reg1in,reg2in,regOut):
+        if self.flagMask & 0x20: # H is not overwritten here
+            self.materializeFlags()
+        self.flagArgs = (reg1in,reg2in,regOut)
+        self.flagMask = 0x0F
+
+    # the single flag setters overwrite their flag without computing the pending ones
+    def setFlagC(self,regOut):
+        self.flagMask &= 0xFE
+        self.sr = self.sr | 1 if (regOut<0 or regOut>255) else self.sr & 0xFE
+
+    def setFlagV(self,reg1in,reg2in,regOut):
+        self.flagMask &= 0xFD
+        v = ((((reg1in & 0x80) == 0x80) & ((reg2in & 0x80) == 0x80) & ((regOut & 0x80) != 0x80)) #overflow
+		| (((reg1in & 0x80) != 0x80) & ((reg2in & 0x80) != 0x80) & ((regOut & 0x80) == 0x80)))  #overflow
+        self.sr = self.sr | 2 if (v) else self.sr & 0xFD
+
+    def resetFlagV(self):
+        self.flagMask &= 0xFD
+        self.sr = self.sr & 0xFD
+
+    def setFlagZ(self,reg1in):
+        self.flagMask &= 0xFB
+        self.sr = self.sr | 4 if (reg1in ==0) else self.sr & 0xFB
+
+    def setFlagN(self,regOut):
+        self.flagMask &= 0xF7
+        self.sr = self.sr | 8 if ((regOut & 0x80) > 0) else self.sr & 0xF7
+
+    def setFlagNZ(self, reg1in):
+        self.flagMask &= 0xF3
+        sr = self.sr | 4 if (reg1in ==0) else self.sr & 0xFB
+        self.sr = sr | 8 if ((reg1in & 0x80) > 0) else sr & 0xF7
+
+
+
 class opcode:
     length= 0
     code = 0
     text = ""
     type= "INH" # inherent
     reg = ""
+    cycles = 0 # clock cycles, from cycleTable
    
     def __init__(self,code,length, text, type, reg):
         self.code = code
@@ -1690,6 +1781,15 @@ class opcode_TXS(opcode):
         return True
     
 
+#--- Illegal opcode: the CPU stops on the codes not implemented
+class opcode_ILL(opcode):
+    def __init__(self,opcode,length,text,type,reg):
+        super().__init__(opcode,length,text,type,reg)
+
+    def execute(self,cpu):
+        return False
+
+
 #--- WAI : Wait for Interrupt
 class opcode_WAI(opcode):
     def __init__(self,opcode,length,text,type,reg):
@@ -1964,13 +2064,190 @@ opcodes = [
 ]
 
 
+#--- Cycles
+# clock cycles of every instruction by addressing mode, from the Motorola M6800 Programming Reference Manual
+# the conditional branches take the same time whether taken or not
+cycleTable = [
+    (["ADC","ADD","AND","BIT","CMP","EOR","LDA","ORA","SBC","SUB"], {"IMM":2, "DIR":3, "IDX":5, "EXT":4}),
+    (["STA"],                                                       {"DIR":4, "IDX":6, "EXT":5}),
+    (["CPX","LDS","LDX"],                                           {"IMM":3, "DIR":4, "IDX":6, "EXT":5}),
+    (["STS","STX"],                                                 {"DIR":5, "IDX":7, "EXT":6}),
+    (["ASL","ASR","CLR","COM","DEC","INC","LSR","NEG","ROL","ROR","TST"], {"ACC":2, "IDX":7, "EXT":6}),
+    (["JMP"],                                                       {"IDX":4, "EXT":3}),
+    (["JSR"],                                                       {"IDX":8, "EXT":9}),
+    (["BCC","BCS","BEQ","BGE","BGT","BHI","BLE","BLS","BLT","BMI","BNE","BPL","BRA","BVC","BVS"], {"REL":4}),
+    (["BSR"],                                                       {"REL":8}),
+    (["ABA","CBA","SBA","TAB","TBA","TAP","TPA","DAA","NOP",
+      "CLC","CLI","CLV","SEC","SEI","SEV"],                         {"ACC":2, "INH":2}),
+    (["PSH","PUL","DES","DEX","INS","INX","TSX","TXS"],             {"ACC":4, "INH":4}),
+    (["RTS"],                                                       {"INH":5}),
+    (["WAI"],                                                       {"INH":9}),
+    (["RTI"],                                                       {"INH":10}),
+    (["SWI"],                                                       {"INH":12}),
+]
+
+for texts,modes in cycleTable:
+    for op in opcodes:
+        if op.text in texts:
+            op.cycles = modes[op.type]
+
+
+# 256 entries dispatch table indexed by the opcode byte
+# the codes not implemented go to the illegal opcode
+# when a code is listed twice (DAA) the first entry wins
+dispatch = [opcode_ILL(code,1,"???","INH","") for code in range(256)]
+for op in reversed(opcodes):
+    dispatch[op.code] = op
+
+
+#--- Specialized handlers
+# Every opcode of the table gets its own execute generated from the execute of its class:
+# self.type, self.reg and self.length become constants, a match on a constant keeps only
+# the matching case and cpu.getRegister/cpu.setRegister become plain attribute accesses,
+# so no string is compared while running. The class execute stays the reference
+# implementation and tests/test_MC6800.py compares both.
+# Generating them takes about half a second: the compiled code is cached in __pycache__,
+# keyed by the hash of this file, and only generated again when the file changed.
+
+registerMasks = {"A":0xFF, "B":0xFF, "IX":0xFFFF, "SP":0xFFFF, "SR":0xFF, "PC":0xFFFF}
+
+
+class Specializer(ast.NodeTransformer):
+    def __init__(self,op):
+        self.op = op
+
+    def isCpuCall(node,name):
+        return (isinstance(node,ast.Call) and isinstance(node.func,ast.Attribute) and node.func.attr == name
+            and isinstance(node.func.value,ast.Name) and node.func.value.id == "cpu"
+            and len(node.args)>0 and isinstance(node.args[0],ast.Constant))
+
+    def matches(pattern,value):
+        match pattern:
+            case ast.MatchValue(value=ast.Constant(value=v)):
+                return v == value
+            case ast.MatchAs(pattern=None):
+                return True
+            case ast.MatchOr(patterns=patterns):
+                return any(Specializer.matches(p,value) for p in patterns)
+        return None # can't be decided here
+
+    def visit_Attribute(self,node):
+        self.generic_visit(node)
+        if (isinstance(node.value,ast.Name) and node.value.id == "self" and isinstance(node.ctx,ast.Load)
+            and node.attr in ["type","reg","length","code","text"]):
+            return ast.copy_location(ast.Constant(getattr(self.op,node.attr)),node)
+        return node
+
+    def visit_Call(self,node):
+        self.generic_visit(node)
+        if Specializer.isCpuCall(node,"getRegister"):
+            reg = node.args[0].value
+            ret = ast.Attribute(ast.Name("cpu",ast.Load()),reg,ast.Load()) if reg in registerMasks else ast.Constant(None)
+            return ast.copy_location(ret,node)
+        return node
+
+    def visit_Expr(self,node):
+        self.generic_visit(node)
+        if Specializer.isCpuCall(node.value,"setRegister") and len(node.value.args)==2:
+            reg = node.value.args[0].value
+            val = node.value.args[1]
+            if reg not in registerMasks:
+                return ast.copy_location(ast.Expr(val),node)
+            if reg == "SR":
+                val = ast.BinOp(val,ast.BitOr(),ast.Constant(0xC0))
+            val = ast.BinOp(val,ast.BitAnd(),ast.Constant(registerMasks[reg]))
+            target = ast.Attribute(ast.Name("cpu",ast.Load()),reg,ast.Store())
+            return ast.copy_location(ast.Assign([target],val),node)
+        return node
+
+    def visit_Match(self,node):
+        self.generic_visit(node)
+        if not isinstance(node.subject,ast.Constant):
+            return node
+        for case in node.cases:
+            found = Specializer.matches(case.pattern,node.subject.value)
+            if found is None or case.guard is not None:
+                return node
+            if found:
+                return case.body
+        return None # no case matches: nothing executed
+
+    def visit_FunctionDef(self,node):
+        self.generic_visit(node)
+        # removing a match can leave a block empty
+        for n in ast.walk(node):
+            if hasattr(n,"body") and isinstance(n.body,list) and len(n.body)==0:
+                n.body.append(ast.Pass())
+        return node
+
+
+executeTrees = {} # opcode class => parsed execute
+
+specializedCache = os.path.join(os.path.dirname(os.path.abspath(__file__)),"__pycache__",
+                                f"MC6800.specialized.{sys.implementation.cache_tag}.bin")
+
+
+# the source of the specialized execute of op, a function named name
+def specializedSource(op,name):
+    cls = type(op)
+    if cls not in executeTrees:
+        executeTrees[cls] = ast.parse(textwrap.dedent(inspect.getsource(cls.execute)))
+    tree = Specializer(op).visit(ast.parse(ast.unparse(executeTrees[cls]))) # works on a copy
+    func = tree.body[0]
+    func.name = name
+    return ast.unparse(func)
+
+
+def specializedName(index,op):
+    return f"op_{index}_{op.code:02X}_{op.text}_{op.type}"
+
+
+# the code defining the specialized execute of every opcode: from the cache when this file did not change
+def specializedCode():
+    with open(__file__,"rb") as f:
+        key = hashlib.sha256(f.read()).digest()
+    try:
+        with open(specializedCache,"rb") as f:
+            if f.read(len(key)) == key:
+                return marshal.load(f)
+    except (OSError,EOFError,ValueError,TypeError):
+        pass
+    source = "\n\n".join(specializedSource(op,specializedName(i,op)) for i,op in enumerate(opcodes))
+    code = compile(source,"<MC6800 specialized>","exec")
+    try:
+        os.makedirs(os.path.dirname(specializedCache),exist_ok=True)
+        fd,tmp = tempfile.mkstemp(dir=os.path.dirname(specializedCache)) # one per process: several may generate at once
+        try:
+            with os.fdopen(fd,"wb") as f:
+                f.write(key + marshal.dumps(code))
+            os.replace(tmp,specializedCache)
+        except OSError:
+            os.unlink(tmp)
+            raise
+    except OSError: # read only install: generated again next time
+        pass
+    return code
+
+
+def specialize():
+    scope = {}
+    exec(specializedCode(),globals(),scope)
+    for i,op in enumerate(opcodes):
+        op.execute = types.MethodType(scope[specializedName(i,op)],op)
+
+
+specialize()
+
 
 if __name__ == '__main__':
 
-    def fetchMem(addr):
+    def fetchMem(addr,peek=False):
         return 0
     
     cpu = MC6800(fetchMem,fetchMem)
 
     for op in opcodes:
-        print(f"{op.code:02X} {op.length} {op.text:3s} {op.type:3s} {op.reg:2s} | {op.decode(cpu,0)}")
\ No newline at end of file
+        print(f"{op.code:02X} {op.length} {op.text:3s} {op.type:3s} {op.reg:2s} | {op.decode(cpu,0)}")
+
+    missing = [op for op in opcodes if op.cycles == 0]
+    print(f"cycle table: {len(opcodes)-len(missing)} ok, {len(missing)} missing {[op.text for op in missing]}")
@@ -18,11 +18,21 @@ class ScreenMemory:
         for i in range(0,pads):
             self.pads.append(curses.newpad(8,50))
 
+    # the memory range of every pad, as debugger.batch and debugger.subscribe queries
+    def ranges(self,debugger:Debugger):
+        return [(debugger.displayStart+i*64,64) for i in range(len(self.pads))]
+
     def refresh(self,debugger:Debugger):
+        self.draw(self.ranges(debugger),debugger.batch(self.ranges(debugger))) # all the pads in one round trip
+
+    # draws the pads from the words read (or pushed) for their ranges
+    def draw(self,ranges,mems):
         for i,p in enumerate(self.pads):
+            if i >= len(ranges):
+                break
             p.clear()
-            startAddr = debugger.displayStart+i*64
-            mem = debugger.get_mem(startAddr,64)
+            startAddr = ranges[i][0]
+            mem = mems[i]
             line = 0
             while line<8:
                 text = f"{startAddr+line*8:04X}: {' '.join(f"{int(m):04X}" for m in mem[line*8:line*8+8])}"
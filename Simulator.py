@@ -1,10 +1,136 @@
-from threading import Thread
-from time import sleep
+import copy
+import pickle
+import zlib
+from array import array
+from collections import deque
+from threading import Condition, RLock, Thread
+from time import perf_counter, sleep
+
+from journal import Journal
+import instructionTrace
+from pagedMemory import PagedMemory
 
 
 class ROMError(Exception): ...
 
 
+maxCycles = 12 # longest instruction of the cycle counting cpus (MC6800 SWI)
+
+snapshotMagic = b"SIMSNAP1"
+
+
+# the memory content as bytes: a bytearray as is, the word memories (hack) as 16 bit words
+def memoryBytes(mem):
+  return bytes(mem) if isinstance(mem,bytearray) else array('H',mem).tobytes()
+
+# rewrites the memory in place so everything holding it sees the new content
+def setMemoryBytes(mem,data):
+  mem[:] = data if isinstance(mem,bytearray) else array('H',data)
+
+# the memory content for fork(): the shared pages of a PagedMemory or else a copy as bytes
+def saveMemory(mem):
+  return mem.checkpoint() if isinstance(mem,PagedMemory) else memoryBytes(mem)
+
+def loadMemory(mem,saved):
+  if isinstance(mem,PagedMemory):
+    mem.restore(saved)
+  else:
+    setMemoryBytes(mem,saved)
+
+
+# write handler for the protected memory pages
+class ROM:
+  def write(self,address,value):
+    raise ROMError(f"ROM protected Area: 0x{address:4X}")
+
+
+# a breakpoint of the breakpoint set (Simulator.addBreakpoint)
+# the condition is a python expression over the cpu registers (A, B, IX, PC, hack A and D...) and
+# M the memory (M[0x1F]), only evaluated when the PC gets to the address. A false condition is not a hit
+# it stops on the count-th hit and every hit after (0 or 1: every hit), a temporary one is removed when it stops
+class Breakpoint:
+  def __init__(self,address,condition=None,count=0,temporary=False):
+    self.address = address
+    self.condition = condition
+    self.code = compile(condition,f"<breakpoint {address:04X}>","eval") if condition else None
+    self.count = count
+    self.hits = 0
+    self.temporary = temporary
+
+  def __str__(self):
+    s = f"{self.address:04X} hits:{self.hits}"
+    if self.count > 1:
+      s += f" count:{self.count}"
+    if self.temporary:
+      s += " temporary"
+    if self.condition:
+      s += f" if {self.condition}"
+    return s
+
+
+# the memory as seen by the breakpoint conditions, read without the device side effects
+class Peek:
+  def __init__(self,simulator):
+    self.simulator = simulator
+
+  def __getitem__(self,address):
+    return self.simulator.fetchMemory(address,True)
+
+
+# the names of the breakpoint conditions: M and the cpu attributes (the hack A() and D() are called)
+class ConditionNames:
+  def __init__(self,simulator):
+    self.simulator = simulator
+
+  def __getitem__(self,name):
+    if name == "M":
+      return Peek(self.simulator)
+    try:
+      value = getattr(self.simulator.cpu,name)
+    except AttributeError:
+      raise KeyError(name)
+    return value() if callable(value) else value
+
+
+# memory watchpoint on the addresses start..end (included), for the reads ("r"), the writes ("w") or both ("rw")
+# it stops the simulator after the instruction doing the access, or only logs it (Simulator.watchLog)
+class Watchpoint:
+  def __init__(self,start,end,access="w",stop=True):
+    self.start = start
+    self.end = end
+    self.access = access
+    self.stop = stop
+    self.hits = 0
+
+  def __str__(self):
+    return f"{self.start:04X}-{self.end:04X} {self.access} {'stop' if self.stop else 'log'} hits:{self.hits}"
+
+
+# handler of a watched address on the memory bus (in the read or the write pages): reports the access
+# then lets the device, the ROM, the other watchpoint or the RAM under it (below) do it
+class WatchHandler:
+  def __init__(self,simulator,watchpoint,below):
+    self.simulator = simulator
+    self.watchpoint = watchpoint
+    self.below = below
+
+  def read(self,address,peek=False):
+    if self.below is not None:
+      value = self.below.read(address,peek)
+    else:
+      value = self.simulator.mem[address % len(self.simulator.mem)]
+    if not peek:
+      self.simulator.watchAccess(self.watchpoint,"r",address,value)
+    return value
+
+  def write(self,address,value):
+    self.simulator.watchAccess(self.watchpoint,"w",address,value)
+    if self.below is not None:
+      self.below.write(address,value)
+    else:
+      self.simulator.mem[address % len(self.simulator.mem)] = value
+
+
 class Simulator(Thread):
   def __init__(self,cpu,mem,devices) -> None:
     Thread.__init__(self,name="SimulatorThread")
@@ -13,52 +139,587 @@ class Simulator(Thread):
       cpu.fetchMemory = self.fetchMemory
       cpu.setMemory = self.setMemory
     self.mem = mem
+    self.rom = None # separate instruction memory of the Harvard cpus (hack), only used by fork/snapshot/restore
     self.devices = devices
     self.protect = [] # an array of tuples of memory ranges to protect from writing
+    self.watchpoints = [] # Watchpoint, mapped on the memory bus with the devices
+    self.watchLog = deque(maxlen=1000) # (PC, access, address, value) of the logging watchpoints
+    self.watchHit = None # (PC, access, address, value) of the stopping watchpoint hit by the last runFor
+    self.watchStops = False # a watchpoint stops: the run loop checks watchHit after every instruction
+    self.unwired = None # memory accessors of a cpu not on the memory bus, while wired to it for the watchpoints
+    self.cpuSetMemory = cpu.setMemory # bottom of the write hooks, None for the cpus writing straight into their ram array (hackCPU.ram)
+    self.writeHooks = [] # (hook, name of the attribute holding the layer under it) wrapping the cpu writes, bottom first
+    self.speculating = False # isSpinning runs the cpu ahead: its reads are not watch accesses
+    self.mapMemory()
+    self.runCondition = Condition() # the thread waits on it while paused
+    self.listeners = [] # called with isRunning whenever the simulator is started or stopped (debugger state pushes)
+    self.lock = RLock() # held by the thread while it executes, the debugger takes it to see one machine state
     self.isRunning = False
     self.delay=0
     self.breakpoint = -1
+    self.breakpoints = {} # the breakpoint set: address => Breakpoint
+    self.breakMap = bytearray(0x10000) # 1 at the addresses of the breakpoint set, checked by the run loop for every instruction
+    self.breakHit = False # the last runFor stopped on a breakpoint
+    self.blockMode = False # execute whole translated blocks when the cpu supports it (stepBlock)
+    self.batchSize = 1000 # instructions executed by the thread between two checks of isRunning
+    self.clock = 0 # pacing mode: target clock in Hz (needs cpu.cycles), 0 runs unthrottled
+    self.timeSlice = 0.01 # seconds of emulated time the thread runs between two sleeps when paced
+    self.deadline = 0 # host time the paced emulation should reach
+    self.spinAction = None # when the cpu spins in a loop it can't leave (cpu.isSpinning): None keeps running it,
+                           # "stop" pauses the simulator (batch jobs), "skip" sleeps instead of running it
+    self.skipped = 0 # instructions not executed by the "skip" spinAction: the batches skipped while the cpu spins
+    self.spinning = False # the last batch ended spinning: with "skip" the next batches check it before running
+    self.instructions = 0 # instructions executed by runFor/runUntil, the time of the journal
+    self.journal = None # Journal of the memory writes while reverse execution is on
+    self.trace = None # instructionTrace.Trace recording every executed instruction while tracing
+    self.traceWrite = None # (address, value) of the memory write of the instruction being traced
     pass
 
-  def fetchMemory(self,address,peek=False):
-    for d in self.devices:
-      if (d.match(address)):
-          return d.read(address,peek)
-      else:
-          return self.mem[address % len(self.mem)]
+  @property
+  def isRunning(self):
+    return self.running
+
+  @isRunning.setter
+  def isRunning(self,value):
+    with self.runCondition:
+      self.running = value
+      self.runCondition.notify_all()
+    for listener in self.listeners:
+      listener(value)
+
+  # the memory bus is a table of 256 pages of 256 bytes
+  # a page is None when it is plain RAM or else holds the handler of each of its addresses
+  # (None for RAM), so every access is one lookup instead of asking all the devices
+  def mapMemory(self):
+    self.readPages = [None] * 256
+    self.writePages = [None] * 256
+    rom = ROM()
+    for start,end in self.protect:
+      for address in range(start,end+1):
+        self.mapAddress(self.writePages,address,rom)
+    for d in self.devices or []: # the devices have priority over the ROM
+      for address in range(0x10000):
+        if d.match(address):
+          self.mapAddress(self.readPages,address,d)
+          self.mapAddress(self.writePages,address,d)
+    for w in self.watchpoints: # on top of everything, only the watched pages leave the fast path
+      for address in range(w.start,w.end+1):
+        for pages,access in [(self.readPages,"r"),(self.writePages,"w")]:
+          if access in w.access:
+            page = pages[(address >> 8) & 0xFF]
+            self.mapAddress(pages,address,WatchHandler(self,w,page and page[address & 0xFF]))
+    self.watchStops = any(w.stop for w in self.watchpoints)
+    self.wireMemory()
+
+  # the cpus of the boards without devices (hack) access their memory directly, not through the bus:
+  # while there are watchpoints they are wired to fetchMemory/setMemory (and off their ram array)
+  def wireMemory(self):
+    if self.devices is not None:
+      return
+    cpu = self.cpu
+    if self.watchpoints and self.unwired is None:
+      self.unwired = (cpu.fetchMemory, getattr(cpu,"ram",None))
+      cpu.fetchMemory = self.fetchMemory
+      if self.unwired[1] is not None:
+        cpu.ram = None
+        cpu.invalidate()
+      self.chainWrites()
+    elif not self.watchpoints and self.unwired is not None:
+      cpu.fetchMemory,ram = self.unwired
+      if ram is not None:
+        cpu.ram = ram
+        cpu.invalidate()
+      self.unwired = None
+      self.chainWrites()
+
+  # the cpu writes go through a chain of hooks (the journal, the trace), each one a method writing
+  # through the layer under it, held in its target attribute. At the bottom is the setMemory of the cpu,
+  # or the memory bus while the cpu is wired to it. Every layer is added and removed on its own
+  def addWriteHook(self,hook,target):
+    self.writeHooks.append((hook,target))
+    self.chainWrites()
+
+  def removeWriteHook(self,hook):
+    self.writeHooks = [(h,target) for h,target in self.writeHooks if h != hook]
+    self.chainWrites()
+
+  def chainWrites(self):
+    below = self.setMemory if self.unwired is not None else self.cpuSetMemory
+    for hook,target in self.writeHooks:
+      setattr(self,target,below or self.setMemory)
+      below = hook
+    self.cpu.setMemory = below
+
+  def addWatchpoint(self,start,end=None,access="w",stop=True):
+    watchpoint = Watchpoint(start,start if end is None else end,access,stop)
+    self.watchpoints.append(watchpoint)
+    self.mapMemory()
+    return watchpoint
 
+  # removes the watchpoints starting at start, all of them when None
+  def removeWatchpoint(self,start=None):
+    self.watchpoints = [w for w in self.watchpoints if start is not None and w.start != start]
+    self.mapMemory()
+
+  def watchAccess(self,watchpoint,access,address,value):
+    if self.speculating:
+      return
+    watchpoint.hits += 1
+    if watchpoint.stop:
+      self.watchHit = (self.cpu.PC,access,address,value)
+    else:
+      self.watchLog.append((self.cpu.PC,access,address,value))
+
+  def mapAddress(self,pages,address,handler):
+    page = (address >> 8) & 0xFF
+    if pages[page] is None:
+      pages[page] = [None] * 256
+    pages[page][address & 0xFF] = handler
+
+  def fetchMemory(self,address,peek=False):
+    page = self.readPages[(address >> 8) & 0xFF]
+    if page is not None:
+      d = page[address & 0xFF]
+      if d is not None:
+        return d.read(address,peek)
     return self.mem[address % len(self.mem)]
 
   def setMemory(self, address, value):
-    if len(self.devices)==0:
-       self.mem[address % len(self.mem)] = value
-    for d in self.devices:
-      if (d.match(address)):
-          d.write(address,value)
-      else:
-        for start,end in self.protect:
-            if address>=start and address<=end:
-                raise ROMError(f"ROM protected Area: 0x{address:4X}")
-        self.mem[address & 0xFFFF] = value
-    
+    page = self.writePages[(address >> 8) & 0xFF]
+    if page is not None:
+      d = page[address & 0xFF]
+      if d is not None:
+        d.write(address,value)
+        return
+    self.mem[address % len(self.mem)] = value
+
+  def addDevice(self,device):
+    self.devices.append(device)
+    self.mapMemory()
         
   def setROM(self,fromAddr,toAddr):
     #we add a protect range
     self.protect.append([fromAddr,toAddr])
+    self.mapMemory()
+
+  # the whole machine state: the cpu registers (cpu.stateNames), the memory, the rom and the devices
+  # kept in memory to restore() it later, as many times as needed. A PagedMemory is not copied,
+  # its pages are shared copy-on-write, so forking costs one pointer per page plus the pages written after
+  # without memory only the registers and the devices are kept (the journal checkpoints)
+  def fork(self,memory=True):
+    return {
+      "cpu": {name:copy.deepcopy(getattr(self.cpu,name)) for name in self.cpu.stateNames},
+      "mem": saveMemory(self.mem) if memory else None,
+      "rom": saveMemory(self.rom) if memory and self.rom is not None else None,
+      "devices": [copy.deepcopy(vars(d)) for d in self.devices or []],
+    }
+
+  # the state of fork() as compact bytes (zlib compressed pickle), also written to fileName when given
+  # only restore the snapshots you made, loading a pickle can run code
+  def snapshot(self,fileName=None):
+    data = snapshotMagic + zlib.compress(pickle.dumps(self.fork()),1)
+    if fileName is not None:
+      with open(fileName,"wb") as f:
+        f.write(data)
+    return data
+
+  # puts the machine back in the state of a fork or of a snapshot (its bytes or its file name)
+  # the board must be built the same way as the one of the snapshot
+  # the journal starts over from there
+  def restore(self,snapshot):
+    if isinstance(snapshot,str):
+      with open(snapshot,"rb") as f:
+        snapshot = f.read()
+    if isinstance(snapshot,dict):
+      state = snapshot
+    elif snapshot.startswith(snapshotMagic):
+      state = pickle.loads(zlib.decompress(snapshot[len(snapshotMagic):]))
+    else:
+      raise ValueError("not a simulator snapshot")
+    self.setState(state)
+    if self.journal is not None:
+      self.startJournal(self.journal.size,self.journal.interval,self.journal.checkpoints.maxlen)
+
+  def setState(self,state):
+    for name,value in state["cpu"].items():
+      setattr(self.cpu,name,copy.deepcopy(value))
+    if state["mem"] is not None:
+      loadMemory(self.mem,state["mem"])
+    if state["rom"] is not None and saveMemory(self.rom) != state["rom"]: # rewriting the rom drops the decoded code
+      loadMemory(self.rom,state["rom"])
+      self.cpu.invalidate()
+    for d,values in zip(self.devices or [],state["devices"]):
+      vars(d).update(copy.deepcopy(values))
+
+  # reverse execution: from now on the memory writes are journaled (see journal.py)
+  # and the cpu writes through journaledSetMemory
+  def startJournal(self,size=0x40000,interval=1000,maxCheckpoints=1000):
+    journaling = self.journal is not None
+    self.journal = Journal(size,interval,maxCheckpoints)
+    self.journal.nextCheckpoint = self.instructions
+    if not journaling:
+      self.addWriteHook(self.journaledSetMemory,"journalTarget")
+
+  def stopJournal(self):
+    if self.journal is not None:
+      self.removeWriteHook(self.journaledSetMemory)
+      self.journal = None
+
+  # only the writes changing the RAM are journaled: not the device or ROM ones, nor the same value again
+  def journaledSetMemory(self,address,value):
+    mem = self.mem
+    a = address % len(mem)
+    old = mem[a]
+    self.journalTarget(address,value)
+    if mem[a] != old: # Journal.record inlined, it runs on every write
+      journal = self.journal
+      i = journal.writes % journal.size
+      journal.addresses[i] = address
+      journal.values[i] = old
+      journal.writes += 1
+
+  # from now on every executed instruction is recorded in a Trace (see instructionTrace.py), in memory
+  # or in a memory mapped file; with memory the cpu writes through tracedSetMemory and the records
+  # also hold the write of their instruction. Tracing steps the cpu one instruction at a time (no blockMode)
+  def startTrace(self,capacity=0x100000,fileName=None,memory=False):
+    self.stopTrace()
+    self.trace = instructionTrace.Trace(type(self.cpu).__name__,capacity,fileName)
+    if memory:
+      self.addWriteHook(self.tracedSetMemory,"traceTarget")
+    return self.trace
+
+  # returns the stopped Trace (its file is closed), None when not tracing
+  def stopTrace(self):
+    trace = self.trace
+    if trace is None:
+      return None
+    self.removeWriteHook(self.tracedSetMemory)
+    self.trace = None
+    trace.close()
+    return trace
+
+  def tracedSetMemory(self,address,value):
+    self.traceTarget(address,value)
+    self.traceWrite = (address & 0xFFFF, value & 0xFFFF)
+
+  # puts the machine at the given instruction count: back in time through the journal
+  # (the device input received meanwhile is not replayed) or forward by running
+  # returns False when it is out of the journal
+  def goTo(self,instructions):
+    journal = self.journal
+    if journal is None:
+      return False
+    if instructions < self.instructions:
+      checkpoint = journal.rewind(instructions) # None once its writes were overwritten in the ring
+      if checkpoint is None:
+        return False
+      time,writes,state = checkpoint
+      journal.undo(writes,self.journalTarget)
+      self.setState(state)
+      self.instructions = time
+    breakpoint,breakpoints = self.breakpoint,self.breakpoints
+    self.breakpoint,self.breakpoints = -1,{}
+    try:
+      while self.instructions < instructions and self.runFor(instructions-self.instructions) > 0:
+        pass
+    finally:
+      self.breakpoint,self.breakpoints = breakpoint,breakpoints
+    return self.instructions == instructions
+
+  def stepBack(self,count=1):
+    return self.goTo(self.instructions-count)
+
+  # goes back to the last time the PC was on the breakpoint or on one of the breakpoint set whose
+  # condition holds, one checkpoint interval at a time. The hit counts only count the forward runs:
+  # they are not checked nor changed, a temporary breakpoint is removed when it is reached
+  # returns False and stays where it was when that is not in the journal
+  def runBack(self):
+    if self.journal is None:
+      return False
+    breakMap = self.breakMap
+    stops = lambda cpu: cpu.PC == self.breakpoint or breakMap[cpu.PC] and self.checkBreakpoint(cpu.PC,False)
+    now = end = self.instructions
+    for start in reversed([checkpoint[0] for checkpoint in self.journal.checkpoints]):
+      if start >= end:
+        continue
+      self.goTo(start)
+      hit = start if stops(self.cpu) else None
+      while self.instructions < end:
+        if self.runUntil(stops,end-self.instructions) == 0:
+          break
+        if self.breakHit and self.instructions < end:
+          hit = self.instructions
+      if hit is not None:
+        if not self.goTo(hit):
+          return False
+        breakpoint = self.breakpoints.get(self.cpu.PC)
+        if breakpoint is not None and breakpoint.temporary:
+          self.removeBreakpoint(self.cpu.PC)
+        return True
+      end = start
+    self.goTo(now)
+    return False
+
+  # executes up to count instructions
+  # stops early on the breakpoint, on a step returning False (illegal opcode, WAI) or on a ROM write
+  # returns the number of executed instructions
+  def runFor(self,count):
+    if self.journal is None:
+      executed = self.runBatch(count)
+      self.instructions += executed
+      return executed
+    executed = 0
+    while executed < count:
+      if self.instructions >= self.journal.nextCheckpoint:
+        self.journal.addCheckpoint(self.instructions,self.fork(memory=False))
+      batch = min(count-executed,self.journal.nextCheckpoint-self.instructions)
+      done = self.runBatch(batch)
+      executed += done
+      self.instructions += done
+      if done < batch or self.breakHit:
+        break
+    return executed
+
+  # runFor in a tight loop, without the instruction count and the journal
+  def runBatch(self,count):
+    if self.trace is not None:
+      return self.runTraced(count)
+    cpu = self.cpu
+    breakpoint = self.breakpoint
+    breakMap = self.breakMap if self.breakpoints else None
+    watchStops = self.watchStops
+    self.breakHit = False
+    self.watchHit = None
+    executed = 0
+    try:
+      if self.blockMode and not watchStops:
+        stepBlock = cpu.stepBlock
+        while executed < count:
+          start = cpu.PC
+          try:
+            executed += stepBlock(breakpoint,count-executed,breakMap)
+          except ROMError: # the block stops on the store raising it, the instructions before it were executed
+            executed += (cpu.PC - start) & 0x7FFF
+            raise
+          if cpu.PC == breakpoint or breakMap is not None and breakMap[cpu.PC] and self.checkBreakpoint(cpu.PC):
+            self.breakHit = True
+            break
+      elif breakpoint < 0 and breakMap is None and not watchStops:
+        step = cpu.step
+        for executed in range(count):
+          if step() is False:
+            return executed
+        executed = count
+      else:
+        step = cpu.step
+        try:
+          for executed in range(1,count+1):
+            if step() is False:
+              return executed-1
+            if cpu.PC == breakpoint or breakMap is not None and breakMap[cpu.PC] and self.checkBreakpoint(cpu.PC) or self.watchHit is not None:
+              self.breakHit = True
+              break
+        except ROMError: # the store raising it is not executed, same as the loop above
+          executed -= 1
+          raise
+    except ROMError:
+      pass
+    return executed
+
+  # runBatch stepping the cpu and recording every instruction in the trace: its state is captured
+  # before the step and packed into the ring buffer after it, with the memory write when there was one
+  def runTraced(self,count):
+    cpu = self.cpu
+    step = cpu.step
+    trace = self.trace
+    capture,pack,buffer = trace.capture,trace.record.pack_into,trace.buffer
+    size,capacity,offset = trace.record.size,trace.capacity,instructionTrace.header.size
+    noWrite = instructionTrace.noWrite
+    n = trace.count
+    breakpoint = self.breakpoint
+    breakMap = self.breakMap if self.breakpoints else None
+    self.breakHit = False
+    self.watchHit = None
+    executed = 0
+    try:
+      for executed in range(1,count+1):
+        state = capture(cpu)
+        self.traceWrite = None
+        if step() is False:
+          executed -= 1
+          break
+        write = self.traceWrite
+        pack(buffer, offset + n % capacity * size, *state, *(noWrite if write is None else (1,*write)))
+        n += 1
+        if cpu.PC == breakpoint or breakMap is not None and breakMap[cpu.PC] and self.checkBreakpoint(cpu.PC) or self.watchHit is not None:
+          self.breakHit = True
+          break
+    except ROMError: # the store raising it is not executed nor recorded
+      executed -= 1
+    finally:
+      trace.count = n
+      trace.sync()
+    return executed
+
+  def addBreakpoint(self,address,condition=None,count=0,temporary=False):
+    breakpoint = Breakpoint(address,condition,count,temporary)
+    self.breakpoints = {**self.breakpoints, address:breakpoint} # replaced, not changed, under a running batch
+    self.breakMap[address] = 1
+    return breakpoint
+
+  # removes the breakpoint at address, all of them when None
+  def removeBreakpoint(self,address=None):
+    breakpoints = dict(self.breakpoints)
+    for a in list(breakpoints) if address is None else [address]:
+      if breakpoints.pop(a,None) is not None:
+        self.breakMap[a] = 0
+    self.breakpoints = breakpoints
+
+  # the PC got to an address of the breakpoint set: True when the run stops there
+  # without counting only the condition is checked (runBack)
+  def checkBreakpoint(self,address,counting=True):
+    breakpoint = self.breakpoints.get(address)
+    if breakpoint is None:
+      return False
+    if breakpoint.code is not None:
+      try:
+        if not eval(breakpoint.code,{"__builtins__":{}},ConditionNames(self)):
+          return False
+      except Exception as e: # stops so the condition can be fixed
+        print(f"breakpoint {address:04X}: {type(e).__name__}: {e}")
+        return True
+    if not counting:
+      return True
+    breakpoint.hits += 1
+    if breakpoint.hits < breakpoint.count:
+      return False
+    if breakpoint.temporary:
+      self.removeBreakpoint(address)
+    return True
+
+  # executes instructions until at least cycles clock cycles were executed (cpu.cycles)
+  # overshoots by less than one instruction, stops early like runFor
+  # returns the number of executed instructions
+  def runCycles(self,cycles):
+    cpu = self.cpu
+    end = cpu.cycles + cycles
+    executed = 0
+    while cpu.cycles < end:
+      count = (end - cpu.cycles) // maxCycles + 1 # can't run past end by more than one instruction
+      done = self.runFor(count)
+      executed += done
+      if done < count or self.breakHit:
+        break
+    return executed
+
+  # True when the cpu sits in a loop it can't leave by itself, for the cpus detecting it
+  def isSpinning(self):
+    isSpinning = getattr(self.cpu,"isSpinning",None)
+    if isSpinning is None:
+      return False
+    self.speculating = True
+    try:
+      return isSpinning()
+    finally:
+      self.speculating = False
+
+  # executes instructions until the condition is met or limit instructions were executed
+  # the condition is either a predicate called with the cpu after every instruction
+  # or a collection of addresses to stop at (checked against the PC)
+  # stops early like runFor, returns the number of executed instructions
+  def runUntil(self,condition,limit=None):
+    if self.journal is None:
+      executed = self.untilBatch(condition,limit)
+      self.instructions += executed
+      return executed
+    executed = 0
+    while executed != limit: # a checkpoint every journal interval, like runFor
+      if self.instructions >= self.journal.nextCheckpoint:
+        self.journal.addCheckpoint(self.instructions,self.fork(memory=False))
+      batch = self.journal.nextCheckpoint-self.instructions
+      if limit is not None:
+        batch = min(batch,limit-executed)
+      done = self.untilBatch(condition,batch)
+      executed += done
+      self.instructions += done
+      if done < batch or self.breakHit:
+        break
+    return executed
+
+  # runUntil without the instruction count and the journal, breakHit tells the condition was met
+  def untilBatch(self,condition,limit):
+    cpu = self.cpu
+    step = cpu.step
+    executed = 0
+    self.breakHit = False
+    try:
+      if callable(condition):
+        while executed != limit:
+          if step() is False:
+            break
+          executed+=1
+          if condition(cpu):
+            self.breakHit = True
+            break
+      else:
+        addresses = set(condition)
+        while executed != limit:
+          if step() is False:
+            break
+          executed+=1
+          if cpu.PC in addresses:
+            self.breakHit = True
+            break
+    except ROMError:
+      pass
+    return executed
 
   def run(self):
     print("Simulator running")
     while True:
-      if self.isRunning:    
-        try:
-          step = self.cpu.step()
-          if (self.breakpoint == self.cpu.PC):
-            self.isRunning = False
-          if self.delay>0:
-             sleep(self.delay)
-        except ROMError as err:
-            self.isRunning = False
-    pass
+      with self.runCondition:
+        while not self.running:
+          self.runCondition.wait()
+      if self.clock>0 and hasattr(self.cpu,"cycles"): # pacing needs the cycle counting cpus
+        self.runSlice()
+        continue
+      if self.delay>0:
+        count = 1
+      else:
+        count = self.batchSize
+      with self.lock: # isSpinning runs the cpu ahead and puts it back, the debugger must not see it in between
+        # still spinning: nothing changes until the memory is written from outside, the batch is not run
+        skip = self.spinAction == "skip" and self.spinning and self.isSpinning()
+        if skip:
+          self.skipped += count
+        else:
+          executed = self.runFor(count)
+          stopped = executed < count or self.breakHit # stopped on breakpoint, illegal opcode or ROM write
+          self.spinning = not stopped and self.spinAction is not None and self.isSpinning()
+      if skip:
+        sleep(self.timeSlice)
+      elif stopped:
+        self.isRunning = False
+      elif self.spinning and self.spinAction == "stop":
+        self.spinning = False
+        self.isRunning = False
+      if self.delay>0:
+        sleep(self.delay)
+
+  # pacing mode: runs one time slice worth of clock cycles then sleeps until the emulated time
+  # when the host is too slow it runs behind, at most one slice of lost time is caught up
+  def runSlice(self):
+    cycles = int(self.clock * self.timeSlice)
+    end = self.cpu.cycles + cycles
+    with self.lock:
+      self.runCycles(cycles)
+    if self.cpu.cycles < end or self.breakHit: # stopped on breakpoint, illegal opcode or ROM write
+      self.isRunning = False
+      return
+    now = perf_counter()
+    self.deadline = max(self.deadline, now - self.timeSlice) + (self.cpu.cycles - end + cycles) / self.clock
+    if self.deadline > now:
+      sleep(self.deadline - now)
   
 
   def pause(self):
@@ -0,0 +1,71 @@
+'''
+ MC6802 board micro-benchmark
+
+ Runs the MicroBasic board from simulator-6802.py (without telnet and debugger)
+ and measures the instructions per second of the opcode dispatch table
+ against the linear opcode search it replaced, and of the lazy flags mode.
+
+ usage: python benchmark-6802.py [instructions] [hexFile ...]
+'''
+
+from sys import argv
+from time import perf_counter
+
+from MC6800.MC6800 import MC6800, MC6800LazyFlags, opcodes
+from Simulator import Simulator
+from utils import loadHex
+
+from devices.z8530 import UART
+
+
+# typed in MicroBasic once the prompt is up, so the interpreter has some work to do
+program = "10 FOR I=1 TO 500\r20 A=I*3+A\r30 NEXT I\r40 PRINT A\rRUN\r"
+
+
+# the opcode search used before the dispatch table
+class linearMC6800(MC6800):
+    def step(self):
+        ops = list(filter(lambda x: x.code == self.fetchMemory(self.PC & 0xFFFF), opcodes))
+        op = ops[0] if ops else None
+        return op.execute(self) if op else False
+
+
+def benchmark(cpu,files,count):
+    ser = UART(0xc7f4)
+    mem = bytearray(0xFFFF+1)
+    for f in files:
+        loadHex(mem,f)
+
+    simulator = Simulator(cpu,mem,[ser])
+    simulator.setROM(0xE000,0xFFFF)
+    cpu.reset()
+
+    keys = list(program)
+    output = ""
+    executed = 0
+    start = perf_counter()
+    while executed < count:
+        # feed the UART between batches so the I/O costs the same for both CPUs
+        for i in range(100):
+            if cpu.step() is False:
+                count = executed
+                break
+            executed+=1
+        c = ser.transmit()
+        if c is not None:
+            output += chr(c)
+        if keys and not ser.RRS[0] & 0x01:
+            ser.receive(ord(keys.pop(0)))
+    elapsed = perf_counter()-start
+    return executed,elapsed,cpu.getRegisters(),output
+
+
+if __name__ == '__main__':
+    count = int(argv[1]) if len(argv)>1 else 200000
+    files = argv[2:] if len(argv)>2 else ["bios.hex","MicroBasic/MicroBasic.hex"]
+
+    baseline = None
+    for cpu in [linearMC6800(),MC6800(),MC6800LazyFlags()]:
+        executed,elapsed,regs,output = benchmark(cpu,files,count)
+        baseline = baseline or executed/elapsed
+        print(f"{type(cpu).__name__:16s} {executed} instructions in {elapsed:.3f}s: {executed/elapsed:10.0f} instr/s ({executed/elapsed/baseline:5.1f}x) {regs}")
@@ -0,0 +1,93 @@
+'''
+ Machine fork benchmark
+
+ Boots a board, then forks many runs from it: each run restores the boot state,
+ executes some instructions and is forked again (kept, as a fuzzer or a search would).
+ Compares the plain memories (bytearray / word list, copied by every fork)
+ with the copy-on-write PagedMemory (only the written pages are copied),
+ for the fork time and the memory held per fork.
+
+ usage: python benchmark-fork.py hack program.rom [forks] [instructions]
+        python benchmark-fork.py 6800 file.hex [file.hex ...] [forks] [instructions]
+'''
+
+import copy
+import tracemalloc
+from sys import argv
+from time import perf_counter
+
+from hackCPU.hackCPU import hackCPU
+from MC6800.MC6800 import MC6800LazyFlags
+from pagedMemory import PagedMemory
+from Simulator import Simulator
+from utils import loadHex, loadMem
+
+from devices.z8530 import UART
+
+
+def hackBoard(files,paged):
+  ram = PagedMemory(0x8000,words=True) if paged else [0x0000] * 0x8000
+  rom = PagedMemory(0x8000,words=True) if paged else [0x0000] * 0x8000
+  for f in files:
+    loadMem(rom,f)
+  cpu = hackCPU(rom.__getitem__,ram.__getitem__,ram.__setitem__)
+  simulator = Simulator(cpu,ram,None)
+  simulator.rom = rom
+  simulator.blockMode = True
+  cpu.reset()
+  return simulator
+
+
+def board6800(files,paged):
+  mem = PagedMemory(0x10000) if paged else bytearray(0x10000)
+  for f in files:
+    loadHex(mem,f)
+  cpu = MC6800LazyFlags()
+  simulator = Simulator(cpu,mem,[UART(0xc7f4)])
+  simulator.setROM(0xE000,0xFFFF)
+  cpu.reset()
+  return simulator
+
+
+def benchmark(simulator,forks,instructions):
+  simulator.runFor(instructions*10) # boot
+  base = simulator.fork()
+  kept = []
+  forkTime = 0
+  for i in range(forks):
+    simulator.restore(base)
+    simulator.runFor(instructions)
+    start = perf_counter()
+    kept.append(simulator.fork())
+    forkTime += perf_counter()-start
+
+  kept = []
+  tracemalloc.start() # slows everything down: measured on a second pass
+  for i in range(forks):
+    simulator.restore(base)
+    simulator.runFor(instructions)
+    kept.append(simulator.fork())
+  size = tracemalloc.get_traced_memory()[0]
+  tracemalloc.stop()
+  return forkTime/forks,size/forks
+
+
+if __name__ == '__main__':
+  kind = argv[1]
+  files = [a for a in argv[2:] if not a.isdigit()]
+  numbers = [int(a) for a in argv[2:] if a.isdigit()]
+  forks = numbers[0] if numbers else 1000
+  instructions = numbers[1] if len(numbers)>1 else 1000
+  build = hackBoard if kind == "hack" else board6800
+
+  for paged in [False,True]:
+    simulator = build(files,paged)
+    forkTime,size = benchmark(simulator,forks,instructions)
+    name = "PagedMemory" if paged else type(simulator.mem).__name__
+    print(f"{name:12s} {forks} forks of {instructions} instructions: {forkTime*1e6:8.1f}us per fork, {size/1024:8.1f}KB per fork")
+
+  mem = build(files,False).mem
+  start = perf_counter()
+  for i in range(100):
+    copy.deepcopy(mem)
+  print(f"deepcopy of the {type(mem).__name__}: {(perf_counter()-start)*1e4:.1f}us")
@@ -1,65 +1,159 @@
+import select
 import socket
+from array import array
 from threading import Thread
 from utils import loadHex,loadS19
 
+import debuggerProtocol as protocol
+
 class Debugger():
     
     def __init__(self):
         self.displayStart = 0
         self.logging = False
+        self.logged = 0 # number of the next trace record log() appends
         self.isRunning = False
         self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self.addr = ('127.0.0.1',54321)
+        self.binary = False # binary protocol negotiated (see debuggerProtocol.py), else text commands
+        self.wordSize = 1 # bytes per memory word of the binary protocol
+        self.nextId = 0
+        self.subscription = None # queries of the subscribed state
+        self.subscriptionId = None # id of the SUBSCRIBE request, carried by its pushes
+        self.pushed = None # latest pushed state not polled yet
 
     
 
-    def log(self):
+    # the simulator records the instructions (trace,on): appends the ones recorded since the last call
+    # (up to count of them), decoded, to debugger.log
+    def log(self,count=1000):
         if self.logging:
-            file1 = open("debugger.log", "a")  # append mode
-            file1.write(self.list_regs(self.cpu))
-            file1.write('| |')
-            opcodes = self.get_opcodes(self.cpu.PC)
-            file1.write(opcodes)
-            match len(opcodes):
-                case 2:
-                    file1.write('      ')
-                case 5:
-                    file1.write('   ')
-            file1.write('| ')
-            file1.write(self.list_cmd(self.cpu.PC))
-            file1.write("\n")
-            file1.close()
+            lines = self.command(f"trace,from,{self.logged},{count}").split('/r/n')
+            if not lines[0].isdigit(): # not tracing
+                return
+            self.logged = int(lines[0])
+            with open("debugger.log", "a") as file1:  # append mode
+                for line in lines[1:]:
+                    file1.write(line + "\n")
         return
 
-    def list_cmd(self,address=None):
-        cmd = b'list_cmd' if address is None else f"list_cmd,{address}".encode()
-        self.socket.sendall(cmd)
-        ret = self.socket.recv(1024).decode()
+    # one binary request, returns the response payload
+    def request(self,kind,payload=b""):
+        id = self.nextId
+        self.nextId = (id+1) & 0xFFFF
+        protocol.sendFrame(self.socket,id,kind,payload)
+        rid,status,ret = self.receive()
+        while status == protocol.PUSH: # pushes can come before the response
+            rid,status,ret = self.receive()
+        if rid != id:
+            raise ConnectionError(f"response {rid} to request {id}")
+        if status != protocol.OK:
+            raise RuntimeError(ret.decode())
         return ret
+
+    # the next frame, keeping the state of the pushes
+    def receive(self):
+        frame = protocol.recvFrame(self.socket)
+        if frame is None:
+            raise ConnectionError("debugger server disconnected")
+        id,status,ret = frame
+        if status == protocol.PUSH and id == self.subscriptionId and self.subscription:
+            self.pushed = self.results(self.subscription,ret)
+        return frame
+
+    # a text command, through a CMD frame once the binary protocol is on
+    def command(self,cmd):
+        if self.binary:
+            try:
+                return self.request(protocol.CMD,cmd.encode()).decode()
+            except RuntimeError:
+                return "err"
+        self.socket.sendall(cmd.encode())
+        return self.socket.recv(1024).decode()
+
+    # several queries in one round trip, all answered from the same machine state
+    # a query is a text command or a (start,length) memory range
+    # returns the text results and the memory words (lists of ints) in the order of the queries
+    def batch(self,queries):
+        if not self.binary: # older server: one round trip each
+            return [self.command(q) if isinstance(q,str) else self.get_mem(*q) for q in queries]
+        return self.results(queries,self.request(protocol.BATCH,self.packBatch(queries)))
+
+    def packBatch(self,queries):
+        return b"".join(protocol.packFrame(i,protocol.CMD,q.encode()) if isinstance(q,str)
+                        else protocol.packFrame(i,protocol.READ,protocol.memoryRange.pack(*q))
+                        for i,q in enumerate(queries))
+
+    # the results of a batch response
+    def results(self,queries,payload):
+        results = []
+        for (id,status,ret),q in zip(protocol.unpackFrames(payload),queries):
+            if isinstance(q,str):
+                results.append(ret.decode() if status == protocol.OK else "err")
+            elif status == protocol.OK:
+                results.append(list(ret) if self.wordSize == 1 else array('H',ret).tolist())
+            else:
+                raise RuntimeError(ret.decode())
+        return results
+
+    # asks the server to push the results of the queries (see batch) when the machine stops or
+    # changes and every interval seconds while it runs, poll() returns them
+    def subscribe(self,queries,interval=0.1):
+        self.subscription = list(queries)
+        self.pushed = None
+        if self.binary:
+            self.subscriptionId = self.nextId
+            self.request(protocol.SUBSCRIBE,protocol.subscription.pack(int(interval*1000))+self.packBatch(queries))
+
+    def unsubscribe(self):
+        self.subscription = None
+        if self.binary:
+            self.request(protocol.SUBSCRIBE,protocol.subscription.pack(0))
+
+    # the latest pushed state, None when nothing changed since the last poll
+    # waits up to timeout seconds for a push, an older server is asked every time instead
+    def poll(self,timeout=0):
+        if not self.binary:
+            return self.batch(self.subscription) if self.subscription else None
+        while select.select([self.socket],[],[],timeout)[0]: # only pushes come unrequested
+            self.receive()
+            timeout = 0
+        state,self.pushed = self.pushed,None
+        return state
+
+    def list_cmd(self,address=None):
+        return self.command('list_cmd' if address is None else f"list_cmd,{address}")
     
 
     def get_opcodes(self,address=None):
-        cmd = b'get_opcodes' if address is None else f"get_opcodes,{address}".encode()
-        self.socket.sendall(cmd)
-        ret = self.socket.recv(1024).decode()
-        return ret
+        return self.command('get_opcodes' if address is None else f"get_opcodes,{address}")
 
     def list_regs(self):
-        self.socket.sendall(b'list_regs')
-        ret = self.socket.recv(1024).decode()
-        return ret
+        return self.command('list_regs')
     
     def list_mem(self,start,length):
-      self.socket.sendall(f"list_mem,{start},{length}".encode())
-      ret = self.socket.recv(1024).decode()
+      ret = self.command(f"list_mem,{start},{length}")
       return ret.split("/r/n")
 
+    # the memory words from start as a list of ints
     def get_mem(self,start,length):
-      self.socket.sendall(f"get_mem,{start},{length}".encode())
-      ret = self.socket.recv(1024).decode()
-      return ret.split("/r/n")
+      if self.binary:
+        data = self.request(protocol.READ,protocol.memoryRange.pack(start,length))
+        return list(data) if self.wordSize == 1 else array('H',data).tolist()
+      ret = self.command(f"get_mem,{start},{length}")
+      return [int(m) for m in ret.split("/r/n")]
+
+    def set_mem(self,start,values):
+      if self.binary:
+        data = bytes(values) if self.wordSize == 1 else array('H',values).tobytes()
+        self.request(protocol.WRITE,protocol.memoryStart.pack(start)+data)
+      else:
+        for i,v in enumerate(values):
+          self.command(f"set,{start+i:X},{v:X}")
 
     def execute(self,cmd):
+      if cmd.strip().lower().startswith(("bp","tbp","trace")): # sent as typed: the conditions and the file names are case sensitive
+        return self.command(cmd.strip())
       cmd = cmd.replace(' ',',').lower()
         
       if cmd.startswith("display"):
@@ -77,12 +171,19 @@ class Debugger():
          if s[1].endswith('.bas'):
             cmd+=",D000"
       
-      self.socket.sendall(cmd.encode())
-      ret = self.socket.recv(1024).decode()
-      return ret
+      return self.command(cmd)
 
         
          
             
     def start(self):
       self.socket.connect(self.addr)
+      self.negotiate()
+
+    # switches to the binary protocol when the server supports it
+    def negotiate(self):
+      ret = self.command(f"protocol,{protocol.version}").split(',')
+      if ret[0] == "protocol" and len(ret) > 2 and int(ret[1]) == protocol.version:
+        self.binary = True
+        self.wordSize = int(ret[2])
+      return self.binary
@@ -0,0 +1,104 @@
+"""
+Binary debugger protocol (version 2)
+
+The debugger server starts every connection with the text protocol: one comma separated
+command per recv, answered with text. A client asks for the binary protocol with the text
+command "protocol,2"; a server supporting it answers "protocol,2,<bytes per memory word>"
+and from then on both sides exchange frames (an older server answers "Invalid Command!"
+and the client stays with the text commands).
+
+A frame is a header followed by its payload:
+  length   uint32  payload length
+  id       uint16  request id, echoed in the response
+  kind     uint8   request kind (CMD, READ, WRITE, BATCH, SUBSCRIBE) or response status (OK, ERROR, PUSH)
+all little endian. The requests:
+  CMD    the payload is a text command, the response is its text result
+  READ   the payload is start,length (uint32 each, in memory words),
+         the response is the raw memory: bytes, or 16 bit little endian words for the hack RAM
+  WRITE  the payload is start (uint32) followed by the raw memory to write, the response is empty
+  BATCH  the payload is a sequence of request frames (their id is their index), all executed on the
+         same machine state (the simulator does not run in between); the response is the sequence
+         of their response frames
+  SUBSCRIBE  the payload is an interval (uint32, milliseconds) followed by a BATCH payload:
+         the server answers at once and then pushes the batch response in PUSH frames carrying the
+         id of the SUBSCRIBE: right away, when the cpu stops or a command changed the machine and,
+         while the simulator runs, every interval (0: only on stops). A push is skipped when the
+         state is the same as the last one, so an idle machine sends nothing.
+         A new SUBSCRIBE replaces the previous one, an empty batch ends it.
+an ERROR response carries the error message as text.
+"""
+
+import asyncio
+import struct
+
+version = 2
+
+header = struct.Struct("<IHB") # payload length, request id, kind or status
+memoryRange = struct.Struct("<II") # start, length of a READ
+memoryStart = struct.Struct("<I") # start of a WRITE
+subscription = struct.Struct("<I") # push interval of a SUBSCRIBE in milliseconds
+
+# request kinds
+CMD = 0
+READ = 1
+WRITE = 2
+BATCH = 3
+SUBSCRIBE = 4
+
+# response status
+OK = 0
+ERROR = 1
+PUSH = 2 # unrequested state of a subscription
+
+
+def packFrame(id,kind,payload=b""):
+  return header.pack(len(payload),id,kind) + payload
+
+
+def sendFrame(sock,id,kind,payload=b""):
+  sock.sendall(packFrame(id,kind,payload))
+
+
+# the (id, kind or status, payload) of the frames packed one after the other in data
+def unpackFrames(data):
+  frames = []
+  offset = 0
+  while offset < len(data):
+    length,id,kind = header.unpack_from(data,offset)
+    offset += header.size
+    frames.append((id,kind,data[offset:offset+length]))
+    offset += length
+  return frames
+
+
+# exactly size bytes from the socket, None when the connection closed before
+def recvExact(sock,size):
+  data = bytearray()
+  while len(data) < size:
+    chunk = sock.recv(size-len(data))
+    if not chunk:
+      return None
+    data += chunk
+  return bytes(data)
+
+
+# the next (id, kind or status, payload) from the socket, None when the connection closed
+def recvFrame(sock):
+  head = recvExact(sock,header.size)
+  if head is None:
+    return None
+  length,id,kind = header.unpack(head)
+  payload = recvExact(sock,length) if length else b""
+  if payload is None:
+    return None
+  return id,kind,payload
+
+
+# the next frame from an asyncio stream (the server side), None when the connection closed
+async def readFrame(reader):
+  try:
+    length,id,kind = header.unpack(await reader.readexactly(header.size))
+    payload = await reader.readexactly(length) if length else b""
+  except asyncio.IncompleteReadError:
+    return None
+  return id,kind,payload
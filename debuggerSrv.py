@@ -1,7 +1,26 @@
-import socket
+import asyncio
+import re
+from array import array
 from threading import Thread
 from utils import loadHex,loadS19
 
+import debuggerProtocol as protocol
+
+
+# addresses are hex by default and d prefixed for decimal
+def parseAddress(text):
+    return int(text[1:],base=10) if text.lower().startswith('d') else int(text,base=16)
+
+
+# one connected client of the debugger server
+class Session:
+    def __init__(self,reader,writer):
+        self.reader = reader
+        self.writer = writer
+        self.binary = False # negotiated the binary protocol
+        self.pusher = None # task pushing the subscribed state
+        self.peer = writer.get_extra_info('peername')
+
 
 class Debugger(Thread):
     
@@ -10,10 +29,16 @@ class Debugger(Thread):
         self.simulator = simulator
         self.cpu = simulator.cpu
         self.mem = simulator.mem
+        self.wordSize = 1 if isinstance(self.mem[0:1],(bytes,bytearray)) else 2 # bytes per memory word, 2 for the hack RAM
         self.displayStart = 0
         self.breakpoint = -1 #means disabled
         self.logging = False
-        self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.trace = None # the last stopped trace, still shown by trace,show
+        self.server = None # asyncio server, serving every client on this thread
+        self.loop = None
+        self.sessions = [] # the connected clients
+        self.changed = None # asyncio.Event set (and replaced) when the machine changed, wakes the pushers
+        simulator.listeners.append(self.simulatorChanged)
         self.isRunning=False
         self.port = 54321
         self.ip = '127.0.0.1'
@@ -38,6 +63,16 @@ class Debugger(Thread):
     def list_regs(self):
         return self.cpu.getRegisters()
     
+    # the raw memory words from start: bytes, or 16 bit little endian words
+    def read_mem(self,start,length):
+        values = self.mem[start:min(start+length,len(self.mem))]
+        return bytes(values) if self.wordSize == 1 else array('H',values).tobytes()
+
+    def write_mem(self,start,data):
+        values = data if self.wordSize == 1 else array('H',data)
+        for i,v in enumerate(values):
+            self.mem[(start+i) % len(self.mem)] = v
+
     def list_mem(self,start,length):
         i = start
         ret = []
@@ -49,9 +84,86 @@ class Debugger(Thread):
         return ret
 
 
+    # the breakpoint set of the simulator (Simulator.addBreakpoint):
+    #   bp,<addr>[,<condition>]   stops at addr, when the condition is true (python: A==0x41, M[0x1F]>3)
+    #   tbp,<addr>[,<condition>]  temporary breakpoint, removed once it stopped
+    #   bpcount,<addr>,<n>        stops on the n-th hit and the ones after
+    #   bpdel[,<addr>]            removes one or all of them
+    #   bplist                    the breakpoints and their hits
+    def breakpointCommand(self,cmd):
+        s = re.split('[ ,]',cmd.strip(),maxsplit=2)
+        name = s[0].lower()
+        if name == "bplist":
+            return '/r/n'.join(str(b) for b in self.simulator.breakpoints.values()) or "none"
+        if name == "bpdel":
+            self.simulator.removeBreakpoint(parseAddress(s[1]) if len(s)>1 else None)
+            return "ok"
+        if name == "bpcount":
+            self.simulator.breakpoints[parseAddress(s[1])].count = int(s[2])
+            return "ok"
+        if name in ("bp","tbp"):
+            breakpoint = self.simulator.addBreakpoint(parseAddress(s[1]),s[2] if len(s)>2 else None,temporary=name=="tbp")
+            return str(breakpoint)
+        return "Invalid Command!"
+
+    # memory watchpoints (Simulator.addWatchpoint), stopping after the instruction unless log is given:
+    #   watch,<start>[,<end>][,log]   on the writes, watch alone lists the watchpoints
+    #   rwatch,<start>[,<end>][,log]  on the reads
+    #   unwatch[,<start>]             removes one or all of them
+    #   watchlog                      the last stop and the logged accesses: PC access address value
+    def watchCommand(self,cmd):
+        s = cmd.split(',')
+        name = s[0]
+        if name == "watchlog":
+            entries = ([self.simulator.watchHit] if self.simulator.watchHit else []) + list(self.simulator.watchLog)
+            return '/r/n'.join(f"{pc:04X} {access} {address:04X} {value:X}" for pc,access,address,value in entries) or "none"
+        if name == "unwatch":
+            self.simulator.removeWatchpoint(parseAddress(s[1]) if len(s)>1 else None)
+            return "ok"
+        addresses = [parseAddress(a) for a in s[1:] if a not in ("","log")]
+        if not addresses:
+            return '/r/n'.join(str(w) for w in self.simulator.watchpoints) or "none"
+        watchpoint = self.simulator.addWatchpoint(addresses[0],addresses[1] if len(addresses)>1 else None,
+                                                  "r" if name == "rwatch" else "w",s[-1] != "log")
+        return str(watchpoint)
+
+    # binary instruction trace (Simulator.startTrace, see instructionTrace.py):
+    #   trace,on[,<file>][,mem]  records every instruction, in a memory mapped file when given, with its memory write for mem
+    #   trace,off                stops recording
+    #   trace,show[,<count>]     the last count (20) recorded instructions, decoded
+    #   trace,from,<n>[,<count>] the next record number then the count (1000) records from record number n, decoded
+    #   trace,save,<file>        writes the trace for python instructionTrace.py <file>
+    def traceCommand(self,cmd):
+        s = cmd.replace(' ',',').split(',')
+        action = s[1].lower() if len(s)>1 else "show"
+        if action == "on":
+            trace = self.simulator.startTrace(fileName=next((a for a in s[2:] if a not in ("","mem")),None),memory="mem" in s[2:])
+            return f"tracing {trace.cpuName}"
+        trace = self.simulator.trace or self.trace
+        if trace is None:
+            return "no trace"
+        if action == "off":
+            self.trace = self.simulator.stopTrace()
+            return f"{trace.count} instructions traced"
+        if action == "save":
+            trace.save(s[2])
+            return "ok"
+        if action == "from":
+            first = max(int(s[2]), trace.count - trace.capacity)
+            end = min(trace.count, first + (int(s[3]) if len(s)>3 else 1000))
+            return '/r/n'.join([str(end)] + list(trace.decode(first=first,end=end)))
+        return '/r/n'.join(trace.decode(int(s[2]) if len(s)>2 else 20)) or "none"
+
     def execute(self,cmd):
+        if cmd.lower().startswith(("bp","tbp")): # before the lower case: the conditions are case sensitive
+            return self.breakpointCommand(cmd)
+        if cmd.lower().startswith("trace"): # before the lower case: the file names are case sensitive
+            return self.traceCommand(cmd)
         cmd = cmd.replace(' ',',').lower()
 
+        if cmd.startswith(("watch","rwatch","unwatch")):
+            return self.watchCommand(cmd)
+
         if cmd == 'list_regs':
             return self.list_regs()
         
@@ -115,16 +227,50 @@ class Debugger(Thread):
             return '/r/n'.join(ret)
 
 
+        if cmd.startswith("batch"): # batch,cmd1;cmd2;... the results one per line, all from the same machine state
+            with self.simulator.lock:
+                return '\n'.join(self.execute(c) for c in cmd[6:].split(';'))
+
+        if cmd.startswith("protocol"): # negotiation of the binary protocol, see debuggerProtocol.py
+            s = cmd.split(',')
+            if len(s)>1 and int(s[1]) == protocol.version:
+                return f"protocol,{protocol.version},{self.wordSize}"
+            return "protocol,1"
+
         if cmd == "reset":
             self.cpu.reset()
             return "ok"
 
         if cmd == "step":
             if self.simulator.isRunning==False:
-                self.cpu.step()
+                self.simulator.runFor(1)
                 ret = self.list_cmd(self.cpu.PC)
                 return ret
             return "running"
+
+        if cmd.startswith("journal"): # reverse execution on/off
+            s = cmd.split(',')
+            if s[1] == "on":
+                self.simulator.startJournal()
+            else:
+                self.simulator.stopJournal()
+            return "ok"
+
+        if cmd.startswith("back"): # step back n instructions (1 by default)
+            if self.simulator.isRunning:
+                return "running"
+            s = cmd.split(',')
+            n = int(s[1]) if len(s)>1 else 1
+            if not self.simulator.stepBack(n):
+                return "not in the journal"
+            return self.list_cmd(self.cpu.PC)
+
+        if cmd == "runback": # back to the last time on the breakpoint
+            if self.simulator.isRunning:
+                return "running"
+            if not self.simulator.runBack():
+                return "not in the journal"
+            return self.list_cmd(self.cpu.PC)
         
         if cmd.startswith('break'):
             s = cmd.split(',')
@@ -208,6 +354,28 @@ class Debugger(Thread):
             self.simulator.delay = v
             return "ok"
         
+        if cmd.startswith("snapshot"): # the lock: registers and memory of the same instruction
+            s = cmd.split(',')
+            with self.simulator.lock:
+                self.simulator.snapshot(s[1])
+            return "saved"
+
+        if cmd.startswith("restore"):
+            if self.simulator.isRunning:
+                return "running"
+            s = cmd.split(',')
+            with self.simulator.lock:
+                self.simulator.restore(s[1])
+            return "restored"
+
+        if cmd.startswith("clock"): # pacing in Hz, 0 runs unthrottled
+            s = cmd.split(',')
+            v = int(s[1])
+            if v and not hasattr(self.cpu,"cycles"):
+                return "the cpu does not count its cycles"
+            self.simulator.clock = v
+            return "ok"
+
         if cmd == "stop":
             self.simulator.isRunning = False
             return "ok"
@@ -223,31 +391,142 @@ class Debugger(Thread):
 
     def run(self):
         self.isRunning=True
-        self.socket.bind((self.ip,self.port))
+        try:
+            asyncio.run(self.serve())
+        except asyncio.CancelledError: # stop()
+            pass
+
+    async def serve(self):
+        self.loop = asyncio.get_running_loop()
+        self.changed = asyncio.Event()
+        self.server = await asyncio.start_server(self.connected,self.ip,self.port)
         print(f"debugger server listening on {self.ip} port {self.port}")
+        async with self.server:
+            await self.server.serve_forever()
+
+    def stop(self):
+        self.isRunning = False
+        if self.loop is not None:
+            self.loop.call_soon_threadsafe(self.server.close)
+
+    # wakes the pushers, on the server thread
+    def notify(self):
+        self.changed.set()
+        self.changed = asyncio.Event()
+
+    # simulator started or stopped (breakpoint, illegal opcode...), from any thread
+    def simulatorChanged(self,running):
+        if self.loop is not None:
+            self.loop.call_soon_threadsafe(self.notify)
+
+    # one task per client: the commands of all the clients run one at a time on the server thread
+    async def connected(self,reader,writer):
+        session = Session(reader,writer)
+        self.sessions.append(session)
+        try:
+            await self.serveText(session)
+            if session.binary:
+                await self.serveFrames(session)
+        except ConnectionError:
+            pass
+        finally:
+            if session.pusher is not None:
+                session.pusher.cancel()
+            self.sessions.remove(session)
+            writer.close()
+
+    # text commands until the client disconnects or switches to the binary protocol
+    async def serveText(self,session):
         while self.isRunning:
+            msg = (await session.reader.read(1024)).decode()
+            if not msg: # client gone
+                return
+            #print(f"DBG: got message: {msg}")
             try:
-                self.socket.listen(1)
-                c,addr = self.socket.accept()
-                #c.send("Debugger connected\r\n".encode())
-                while self.isRunning:
-                    try:  
-                        msg = c.recv(1024).decode()
-                        #print(f"DBG: got message: {msg}")
-                        try:
-                            ret = self.execute(msg)
-                        #print(f"DBG: response: {ret}")
-                        except:
-                            print(F"ERR: executing: {msg}")
-                            ret ="err"
-                        c.sendall(ret.encode())
-                    except socket.timeout:
-                        print("socket timeout")
-                        continue
-                    
-                c.close()
+                ret = self.execute(msg)
+            #print(f"DBG: response: {ret}")
+            except:
+                print(F"ERR: executing: {msg}")
+                ret ="err"
+            self.notify()
+            session.writer.write(ret.encode())
+            await session.writer.drain()
+            if ret.startswith(f"protocol,{protocol.version},"):
+                session.binary = True
+                return
+
+
+    # one request of the binary protocol, returns the response payload
+    def request(self,kind,payload):
+        if kind == protocol.CMD:
+            return self.execute(payload.decode()).encode()
+        if kind == protocol.READ:
+            start,length = protocol.memoryRange.unpack(payload)
+            return self.read_mem(start,length)
+        if kind == protocol.WRITE:
+            start, = protocol.memoryStart.unpack_from(payload)
+            self.write_mem(start,payload[protocol.memoryStart.size:])
+            return b""
+        if kind == protocol.BATCH:
+            with self.simulator.lock:
+                return b"".join(self.batchResponse(id,kind,payload) for id,kind,payload in protocol.unpackFrames(payload))
+        raise ValueError(f"unknown request kind {kind}")
+
+    # the response frame of one request of a batch, a failed one doesn't stop the others
+    def batchResponse(self,id,kind,payload):
+        try:
+            return protocol.packFrame(id,protocol.OK,self.request(kind,payload))
+        except Exception as e:
+            return protocol.packFrame(id,protocol.ERROR,str(e).encode())
+
+    # serves the binary frames of a client until it disconnects
+    async def serveFrames(self,session):
+        while self.isRunning:
+            frame = await protocol.readFrame(session.reader)
+            if frame is None:
+                return
+            id,kind,payload = frame
+            try:
+                if kind == protocol.SUBSCRIBE:
+                    status,ret = protocol.OK,self.subscribe(session,id,payload)
+                else:
+                    status,ret = protocol.OK,self.request(kind,payload)
             except Exception as e:
-                print(f"socket exception: {type(e)}")
-                print(e)
-                continue
-        
\ No newline at end of file
+                print(f"ERR: executing request {kind}: {e}")
+                status,ret = protocol.ERROR,str(e).encode()
+            if kind in (protocol.CMD,protocol.WRITE):
+                self.notify()
+            session.writer.write(protocol.packFrame(id,status,ret))
+            await session.writer.drain()
+
+    # replaces the subscription of the session, see SUBSCRIBE in debuggerProtocol.py
+    def subscribe(self,session,id,payload):
+        interval, = protocol.subscription.unpack_from(payload)
+        queries = payload[protocol.subscription.size:]
+        if session.pusher is not None:
+            session.pusher.cancel()
+            session.pusher = None
+        if queries:
+            session.pusher = asyncio.create_task(self.push(session,id,queries,interval/1000))
+        return b""
+
+    # pushes the batch response of the queries whenever it changes
+    async def push(self,session,id,queries,interval):
+        last = None
+        try:
+            while True:
+                changed = self.changed # taken before reading the state so no change is missed
+                state = self.request(protocol.BATCH,queries)
+                if state != last:
+                    session.writer.write(protocol.packFrame(id,protocol.PUSH,state))
+                    await session.writer.drain()
+                    last = state
+                if self.simulator.isRunning and interval > 0:
+                    try:
+                        await asyncio.wait_for(changed.wait(),interval)
+                    except asyncio.TimeoutError:
+                        pass
+                else: # idle until something changes
+                    await changed.wait()
+        except ConnectionError:
+            pass
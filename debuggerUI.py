@@ -12,13 +12,25 @@ cmdPrompt = "> "
 class DebuggerUI:
     
 
-    def topRefresh(self,screen,padTop,debugger):
+    def topRefresh(self,screen,padTop,top):
         y, x = screen.getmaxyx()
         padTop.clear()
-        topStr = f"{debugger.list_regs()}| |{debugger.get_opcodes()}| {debugger.list_cmd()}"
+        regs,opcodes,cmd = top
+        topStr = f"{regs}| |{opcodes}| {cmd}"
         padTop.addstr(topStr)
         padTop.refresh(0,0,0,0,0, x-1 )
 
+    # the server pushes the top line and the memory pads (all from the same instruction) when they change
+    def subscribe(self,debugger,winMem):
+        self.ranges = winMem.ranges(debugger)
+        debugger.subscribe(["list_regs","get_opcodes","list_cmd"]+self.ranges)
+        self.state = None
+
+    def render(self,screen,padTop,winMem,state):
+        self.state = state
+        self.topRefresh(screen,padTop,state[:3])
+        winMem.draw(self.ranges,state[3:])
+
 
 
     def main(self,screen, debugger):
@@ -44,9 +56,10 @@ class DebuggerUI:
                     
         while True: # this is the main loop
             screen.erase()
-            self.topRefresh(screen,padTop,debugger)
-
-            winMem.refresh(debugger)
+            self.subscribe(debugger,winMem)
+            state = debugger.poll(1) # the first push comes right away
+            if state is not None:
+                self.render(screen,padTop,winMem,state)
             winBot.nodelay(True) 
             cmdDebug = ''
             while True:
@@ -66,7 +79,9 @@ class DebuggerUI:
                 except:
                     ch = None
                 
-                self.topRefresh(screen,padTop,debugger)
+                state = debugger.poll() # no round trip, only what the server pushed
+                if state is not None:
+                    self.render(screen,padTop,winMem,state)
                 if ch == curses.ERR:
                     continue
 
@@ -98,13 +113,11 @@ class DebuggerUI:
                     winMem.resize()
                     screen.clear()
                     screen.refresh()
-                    winMem.refresh(debugger)
                     
                     #winTop.resize(1,x) # curses.newwin(1,x,0,0)
                     winBot.resize(1,x) # curses.newwin(1,x,11,0)
                     
-                    self.topRefresh(screen,padTop,debugger)
-                    break
+                    break # subscribes again for the new pads
                 if (ch!= None) and type(ch)==str:
                     cmdDebug+=ch
                 elif (ch != None) & (ch < 128) & (ch >=0):
@@ -13,11 +13,12 @@ class UART:
             return True
         return False
 
-    def read(self,addr):
+    def read(self,addr,peek=False):
         if (addr == self.baseAddr):
             return self.SR
         if (addr == self.baseAddr+1):
-            self.SR = self.SR & 0xFE
+            if peek==False:
+                self.SR = self.SR & 0xFE
             return self.RDR
         
     def write(self,addr, val):
@@ -25,11 +25,12 @@ class UART:
         return False
 
     #read internal register 
-    def read(self,addr):
+    def read(self,addr,peek=False):
         a02 = addr - self.baseAddr
         if a02 == 0:
             if self.LCR & 0x80 == 0:
-                self.LSR = self.LSR & 0xFE # we mark the register as empty
+                if peek==False:
+                    self.LSR = self.LSR & 0xFE # we mark the register as empty
                 return self.RHR
             else:
                 return self.DLL
@@ -0,0 +1,138 @@
+'''
+ Simulator farm
+
+ Runs many simulator jobs over a multiprocessing pool. Every worker builds its own board
+ (cpu, memory, devices and Simulator) in its process and runs it with Simulator.runFor,
+ without the Simulator thread, the debugger socket or the telnet server,
+ so any number of runs fit on one host.
+
+ A job is a dict:
+   cpu:     "6800" (the MC6802 board of simulator-6802.py) or "hack" (the board of simulator-hack.py)
+   images:  files loaded in order, into the memory (6800) or the ROM (hack)
+   loader:  "hex", "s19" or "mem", by default from the file extension (.rom files are mem files)
+   input:   text typed in: sent to the UART (6800) or pressed on the keyboard for keyTime instructions (hack)
+   budget:  instructions to run at most (default 1000000)
+   memory:  [[start,end],...] memory ranges to return (end included)
+   rom:     [[start,end],...] write protected ranges of the 6800 board (default E000-FFFF)
+ the run stops early on an illegal opcode or WAI (6800) or when the program spins with no input left (hack)
+
+ A result is a dict with the job index, the executed instructions, the final registers,
+ the UART output, the memory ranges as bytes (hack words as little endian 16 bits) and the run time,
+ or with the job index and the error when the job failed (the other jobs still run).
+
+ usage: python farm.py jobs.json [processes]   (prints one json result per line)
+'''
+
+import json
+from array import array
+from multiprocessing import Pool
+from sys import argv
+from time import perf_counter
+
+from hackCPU.hackCPU import hackCPU
+from MC6800.MC6800 import MC6800LazyFlags
+from Simulator import Simulator
+from utils import loadHex, loadMem, loadS19
+
+from devices.z8530 import UART
+
+loaders = {"hex":loadHex, "s19":loadS19, "mem":loadMem, "rom":loadMem}
+
+keyTime = 100000 # instructions a hack key stays pressed, then as long released
+uartPoll = 100 # instructions between two transfers of the 6800 UART
+
+
+def load(mem,job):
+  for f in job.get("images",[]):
+    loader = job.get("loader") or f.split('.')[-1]
+    if loader not in loaders:
+      raise ValueError(f"{f}: unknown loader {loader!r}, expected one of {', '.join(loaders)}")
+    loaders[loader](mem,f)
+
+
+def run6800(job):
+  ser = UART(0xc7f4)
+  mem = bytearray(0xFFFF+1)
+  load(mem,job)
+  cpu = MC6800LazyFlags()
+  simulator = Simulator(cpu,mem,[ser])
+  for start,end in job.get("rom",[[0xE000,0xFFFF]]):
+    simulator.setROM(start,end)
+  cpu.reset()
+
+  keys = list(job.get("input",""))
+  output = []
+  budget = job.get("budget",1000000)
+  executed = 0
+  while executed < budget:
+    count = min(uartPoll,budget-executed)
+    done = simulator.runFor(count)
+    executed += done
+    c = ser.transmit()
+    if c is not None:
+      output.append(chr(c))
+    if keys and not ser.RRS[0] & 0x01:
+      ser.receive(ord(keys.pop(0)))
+    if done < count:
+      break
+  memory = [bytes(mem[start:end+1]) for start,end in job.get("memory",[])]
+  return executed,cpu.getRegisters(),"".join(output),memory
+
+
+def runHack(job):
+  ram = array('H',bytes(0x10000))
+  rom = array('H',bytes(0x10000))
+  load(rom,job)
+  cpu = hackCPU(rom.__getitem__,ram.__getitem__,None,ram=ram)
+  simulator = Simulator(cpu,ram,None)
+  simulator.rom = rom
+  simulator.blockMode = True
+  cpu.reset()
+
+  keys = list(job.get("input",""))
+  budget = job.get("budget",1000000)
+  executed = 0
+  while executed < budget:
+    if keys: # press, hold and release the next key
+      ram[24576] = ord(keys.pop(0))
+      executed += simulator.runFor(min(keyTime,budget-executed))
+      ram[24576] = 0
+    executed += simulator.runFor(min(keyTime,budget-executed))
+    if not keys and cpu.isSpinning():
+      break
+  memory = [array('H',ram[start:end+1]).tobytes() for start,end in job.get("memory",[])]
+  return executed,cpu.getRegisters(),"",memory
+
+
+boards = {"6800":run6800, "hack":runHack}
+
+
+# runs one job in the worker process, a failing job gives an error result instead of stopping the run
+def runJob(indexedJob):
+  index,job = indexedJob
+  start = perf_counter()
+  try:
+    if job.get("cpu") not in boards:
+      raise ValueError(f"unknown cpu {job.get('cpu')!r}, expected one of {', '.join(boards)}")
+    executed,registers,output,memory = boards[job["cpu"]](job)
+  except Exception as e:
+    return {"job":index, "error":repr(e), "elapsed":perf_counter()-start}
+  return {"job":index, "instructions":executed, "registers":registers, "output":output,
+          "memory":memory, "elapsed":perf_counter()-start}
+
+
+# runs the jobs over processes worker processes (all the cpus by default)
+# yields the results in the order of the jobs
+def runJobs(jobs,processes=None):
+  with Pool(processes) as pool:
+    yield from pool.imap(runJob, enumerate(jobs))
+
+
+if __name__ == '__main__':
+  with open(argv[1]) as f:
+    jobs = json.load(f)
+  processes = int(argv[2]) if len(argv)>2 else None
+  for result in runJobs(jobs,processes):
+    if "memory" in result:
+      result["memory"] = [m.hex() for m in result["memory"]]
+    print(json.dumps(result))
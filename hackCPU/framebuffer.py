@@ -0,0 +1,61 @@
+"""
+hack Computer framebuffer without pygame
+
+video memory starts at 16384 and is 8K long
+512x256 pixels, each line is 32 words of 16 pixels, bit 0 is the leftmost one
+
+used by the pygame Screen and by the headless runner to dump frames
+as PNG files or as a raw monob video stream (ffmpeg -f rawvideo -pix_fmt monob -s 512x256)
+"""
+
+import struct
+import zlib
+from array import array
+
+import numpy as np
+
+screen_width = 512
+screen_height = 256
+screen_base = 16384
+
+
+# the video memory of an array('H') or numpy ram as an array indexed [row,word], sharing the ram (no copy)
+def screenView(ram):
+  return np.frombuffer(ram, dtype=np.uint16)[screen_base:screen_base+screen_height*32].reshape(screen_height,32)
+
+
+# the words of the given screen rows as an array indexed [row,word]
+def screenWords(ram,rows=range(screen_height)):
+  if isinstance(ram,(array,np.ndarray)):
+    return screenView(ram)[rows]
+  return np.array([ram[screen_base+y*32:screen_base+y*32+32] for y in rows], dtype=np.uint16).reshape(-1,32)
+
+
+# the pixels of the words of screenWords as an array of 0/1 indexed [row,x]
+def screenBits(words):
+  return np.unpackbits(words.astype("<u2").view(np.uint8), axis=1, bitorder="little")
+
+
+# the whole screen packed 1 bit per pixel, 64 bytes per row, leftmost pixel in the highest bit,
+# 1 for white and 0 for black like both the PNG grayscale and the monob formats
+def frameBytes(ram):
+  return np.packbits(1 - screenBits(screenWords(ram)), axis=1).tobytes()
+
+
+def pngChunk(kind,data):
+  return struct.pack(">I",len(data)) + kind + data + struct.pack(">I",zlib.crc32(kind + data))
+
+
+# the screen as a 1 bit grayscale PNG image
+def pngBytes(ram):
+  frame = frameBytes(ram)
+  rows = b"".join(b"\x00" + frame[y*64:y*64+64] for y in range(screen_height)) # filter type 0 before every row
+  return (b"\x89PNG\r\n\x1a\n"
+          + pngChunk(b"IHDR", struct.pack(">IIBBBBB", screen_width, screen_height, 1, 0, 0, 0, 0))
+          + pngChunk(b"IDAT", zlib.compress(rows))
+          + pngChunk(b"IEND", b""))
+
+
+def savePNG(ram,fileName):
+  with open(fileName,"wb") as f:
+    f.write(pngBytes(ram))
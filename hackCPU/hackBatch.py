@@ -0,0 +1,157 @@
+"""
+ hack CPU lockstep engine
+
+ Runs N hack machines on the same ROM at once: A, D, PC and the RAM of every machine are
+ rows of numpy arrays and each step executes one instruction for all the machines,
+ vectorized over the machines sharing a PC (the ones that diverged run as separate groups
+ until their PCs meet again). Meant for running one program over many inputs
+ (keyboard values, seeds poked in the RAM) where N hackCPUs would each pay the python
+ overhead of every instruction.
+
+ Same semantic as hackCPU: M is written before A and the jump uses the new A.
+ The zr/ng flags are not kept, no instruction reads them.
+
+ usage: python -m hackCPU.hackBatch program.rom [machines] [steps]
+"""
+
+import numpy as np
+
+from hackCPU.hackCPU import compExpr, opcodes
+
+
+# the jump conditions as numpy expressions over the ALU output
+jumpExpr = {
+  0b001: "(val != 0) & ((val & 0x8000) == 0)",   #JGT
+  0b010: "val == 0",                             #JEQ
+  0b011: "(val & 0x8000) == 0",                  #JGE
+  0b100: "(val & 0x8000) != 0",                  #JLT
+  0b101: "val != 0",                             #JNE
+  0b110: "(val == 0) | ((val & 0x8000) != 0)",   #JLE
+}
+
+handlers = {} # instruction word => handler(batch,rows)
+
+
+def handlerA(instr):
+  def handler(batch,rows):
+    batch.A[rows] = instr
+    batch.PC[rows] = (batch.PC[rows] + 1) & 0x7FFF # wraps at the end of the ROM like hackCPU
+  return handler
+
+
+# dest=comp;jump for the machines of rows
+def handlerC(instr):
+  dest = (instr >> 3) & 0x07
+  jump = (instr & 0x07)
+  comp = (instr >> 6) & 0x7F
+
+  src  = "def handler(batch,rows):\n"
+  src += "  a = batch.A[rows]\n"
+  src += "  d = batch.D[rows]\n"
+  src += "  val = " + compExpr[comp].format(A="a",D="d",M="batch.ram[rows,a & 0x7FFF].astype(np.int64)") + "\n"
+  if dest & 0b001: # store into M
+    src += "  batch.ram[rows,a & 0x7FFF] = val\n"
+  if dest & 0b010: # store into D
+    src += "  batch.D[rows] = val\n"
+  if dest & 0b100: # store into A
+    src += "  batch.A[rows] = val\n"
+    src += "  a = val\n"
+  if jump == 0b000:
+    src += "  batch.PC[rows] = (batch.PC[rows] + 1) & 0x7FFF\n"
+  elif jump == 0b111:
+    src += "  batch.PC[rows] = a & 0x7FFF\n"
+  else:
+    src += f"  batch.PC[rows] = np.where({jumpExpr[jump]}, a & 0x7FFF, (batch.PC[rows]+1) & 0x7FFF)\n"
+
+  scope = {"np":np}
+  exec(compile(src,f"<hack batch 0x{instr:04X}: {opcodes[1].getText(instr)}>","exec"),scope)
+  return scope["handler"]
+
+
+def getHandler(instr):
+  handler = handlers.get(instr)
+  if handler is None:
+    handler = handlers[instr] = handlerA(instr) if not instr & 0x8000 else handlerC(instr)
+  return handler
+
+
+class hackBatch:
+
+  def __init__(self,rom,machines):
+    self.rom = rom
+    self.machines = machines
+    self.ram = np.zeros((machines,0x8000), dtype=np.uint16) # one row per machine
+    self.all = np.arange(machines)
+    self.decoded = {} # ROM address => handler
+    self.reset()
+
+  def reset(self):
+    self.PC = np.zeros(self.machines, dtype=np.int64)
+    self.A  = np.zeros(self.machines, dtype=np.int64)
+    self.D  = np.zeros(self.machines, dtype=np.int64)
+    self.steps = 0
+
+  def handler(self,addr):
+    handler = self.decoded.get(addr)
+    if handler is None:
+      handler = self.decoded[addr] = getHandler(self.rom[addr])
+    return handler
+
+  # executes one instruction on every machine
+  def step(self):
+    pc = self.PC
+    first = int(pc[0])
+    if (pc == first).all(): # lockstep
+      self.handler(first)(self,self.all)
+    else: # one group per distinct PC, all computed before any of them runs
+      order = np.argsort(pc, kind="stable")
+      pcs,starts = np.unique(pc[order], return_index=True)
+      for addr,rows in zip(pcs.tolist(), np.split(order,starts[1:])):
+        self.handler(addr)(self,rows)
+    self.steps+=1
+
+  def run(self,steps):
+    for i in range(steps):
+      self.step()
+
+  # number of distinct PCs, 1 when all the machines run in lockstep
+  def groups(self):
+    return len(np.unique(self.PC))
+
+  def getRegisters(self,machine):
+    return "|PC:{0:04X}|A:{1:04X}|D:{2:04X}|".format(int(self.PC[machine]), int(self.A[machine]), int(self.D[machine]))
+
+
+
+if __name__ == '__main__':
+  from sys import argv
+  from time import perf_counter
+
+  from hackCPU.hackCPU import hackCPU
+  from utils import loadMem
+
+  rom = [0] * 0x8000
+  loadMem(rom,argv[1])
+  machines = int(argv[2]) if len(argv)>2 else 256
+  steps = int(argv[3]) if len(argv)>3 else 100000
+
+  # every machine gets its own keyboard value, so they diverge when the program reads it
+  batch = hackBatch(rom,machines)
+  batch.ram[:,24576] = [32 + i % 64 for i in range(machines)]
+  start = perf_counter()
+  batch.run(steps)
+  elapsed = perf_counter()-start
+  print(f"{machines} machines x {steps} steps in {elapsed:.3f}s: {machines*steps/elapsed:.0f} instr/s, {batch.groups()} groups at the end")
+
+  # compare a few machines against hackCPU
+  start = perf_counter()
+  for i in range(min(machines,4)):
+    ram = [0] * 0x8000
+    ram[24576] = 32 + i % 64
+    cpu = hackCPU(lambda addr: rom[addr & 0x7FFF], lambda addr: ram[addr & 0x7FFF], lambda addr,val: ram.__setitem__(addr & 0x7FFF,val))
+    for s in range(steps):
+      cpu.step()
+    same = (cpu.PC & 0x7FFF, cpu.registers[0], cpu.registers[1]) == (int(batch.PC[i]), int(batch.A[i]), int(batch.D[i])) and ram == batch.ram[i].tolist()
+    print(f"machine {i}: {batch.getRegisters(i)} hackCPU: {cpu.getRegisters()} {'same' if same else 'DIFFERENT'}")
+  elapsed = perf_counter()-start
+  print(f"hackCPU: {min(machines,4)*steps/elapsed:.0f} instr/s")
@@ -16,17 +16,22 @@ import pathlib
 
 
 class hackCPU:
-    
+  stateNames = ["PC","registers","zr","ng"] # saved by Simulator.snapshot
+
   def reset(self):
     self.PC = 0
     self.registers = [0,0] # [A,D]
     self.ng = False
     self.zr = True
+    self.invalidate() # the ROM is usually (re)loaded just before a reset
 
-  def __init__(self,fetchInstruction,fetchMemory,setMemory):
+  def __init__(self,fetchInstruction,fetchMemory,setMemory,ram=None):
     self.fetchInstruction = fetchInstruction
     self.fetchMemory = fetchMemory
     self.setMemory = setMemory
+    # fast path: the RAM (array('H')) indexed directly instead of calling fetchMemory,
+    # and written directly while setMemory is None (set a setMemory to hook the writes)
+    self.ram = ram
     self.reset()
 
   def A(self):
@@ -36,6 +41,8 @@ class hackCPU:
     return self.registers[1]
   
   def M(self):
+    if self.ram is not None:
+      return self.ram[self.registers[0] & 0x7FFF]
     return self.fetchMemory(self.registers[0])
       
   def setA(self,val):
@@ -45,23 +52,86 @@ class hackCPU:
     self.registers[1] = val
   
   def setM(self,val):
-    self.setMemory(self.registers[0], val)
+    if self.setMemory is None:
+      self.ram[self.registers[0] & 0x7FFF] = val
+    else:
+      self.setMemory(self.registers[0], val)
     
     
   def step(self):
-    #op,instr = self.getOpcode(self.PC)
-    #return op.execute(self,instr)
-
-  #def getOpcode(self,addr):
-    instr = self.fetchInstruction(self.PC)
-    if instr & 0x8000:
-      return opcodes[1].execute(self,instr)
+    # every ROM word is decoded only once into a specialized handler
+    return self.decoded[self.PC & 0x7FFF](self)
+
+  # drops the decoded handler for one ROM address or for the whole ROM
+  # must be called whenever the ROM content is rewritten
+  def invalidate(self,address=None):
+    if address is None:
+      self.decoded = [decodeAt] * 0x8000
     else:
-      return opcodes[0].execute(self,instr)
-    #index = instr >> 15
-    #op = opcodes[index]
-    #return op,instr
-  
+      self.decoded[address & 0x7FFF] = decodeAt
+    self.blocks = [None] * 0x8000 # translated blocks by entry address
+    self.atEntry = True # PC is where a block starts: after a jump or a whole block, not inside a cut block
+
+  # executes the whole basic block starting at PC as one translated python function
+  # falls back to step() when the breakpoint, or one of breakMap (Simulator.breakMap), is inside
+  # the block so it is not skipped, or when the block is longer than limit instructions
+  # inside a block cut that way (by the batch limit of Simulator.runFor) it steps to the end of the
+  # block instead of translating a new block from there: compiling one costs as much as stepping
+  # thousands of instructions and a batch limit lands on a different address every time
+  # returns the number of executed instructions
+  def stepBlock(self,breakpoint=-1,limit=0x8000,breakMap=None):
+    addr = self.PC & 0x7FFF
+    block = self.blocks[addr]
+    if block is None:
+      if not self.atEntry:
+        return self.stepInside(addr)
+      block = self.blocks[addr] = translateBlock(self,addr)
+    if addr < breakpoint <= block.end or block.end-addr >= limit or breakMap is not None and breakMap.find(1,addr+1,block.end+1) >= 0:
+      return self.stepInside(addr)
+    self.atEntry = True
+    return block(self)
+
+  # steps one instruction of a block: the next one starts a block after a jump
+  def stepInside(self,addr):
+    instr = self.fetchInstruction(addr)
+    self.atEntry = bool(instr & 0x8000 and instr & 0x07)
+    self.step()
+    return 1
+
+  # True when the cpu sits in a loop it can't leave by itself: the blocks run from PC don't write
+  # the memory and come back to an address with the same A and D, so every iteration is the same
+  # until something else writes the memory (the keyboard), e.g. (END) @END 0;JMP or a keyboard
+  # wait loop. Loops of more than maxSpinBlocks blocks or writing the memory are not detected
+  def isSpinning(self):
+    registers = self.registers[:]
+    state = (self.PC, self.zr, self.ng)
+    seen = set()
+    spinning = False
+    for i in range(maxSpinBlocks+1):
+      addr = self.PC & 0x7FFF
+      if (addr,self.registers[0],self.registers[1]) in seen:
+        spinning = True
+        break
+      seen.add((addr,self.registers[0],self.registers[1]))
+      block = self.blocks[addr]
+      if block is None:
+        block = self.blocks[addr] = translateBlock(self,addr)
+      if not block.pure:
+        break
+      block(self) # only reads the memory
+    self.registers[:] = registers
+    self.PC, self.zr, self.ng = state
+    return spinning
+
+  # decodes the whole ROM upfront instead of on first execution
+  def decodeROM(self):
+    self.decoded = [getHandler(self.fetchInstruction(addr),self.ram is not None) for addr in range(0x8000)]
+
+  # the opcode at index and the instruction word (the whole instruction for the debugger and the trace)
+  def getOpcode(self,index):
+    instr = self.fetchInstruction(index & 0x7FFF)
+    return opcodes[1 if instr & 0x8000 else 0],instr
+
   def getRegisters(self):
     return "|PC:{0:04X}|A:{1:04X}|D:{2:04X}|Z:{3:d}|N:{4:d}|".format(self.PC, self.registers[0], self.registers[1], self.zr, self.ng )
 
@@ -310,6 +380,217 @@ opcodes = [
 ]
 
 
+"""
+Decoded instructions cache
+
+Each distinct instruction word gets one handler(cpu) specialized for its comp/dest/jump
+combination, with the ALU expression inlined, so no table lookups happen at execution time.
+The handlers do not depend on the cpu instance so they are shared by all the hackCPUs.
+"""
+
+# the ALU computations as python expressions over the A, D and M operands
+compExpr = {
+  0b0101010: "0",                          #0
+  0b0111111: "1",                          #1
+  0b0111010: "0xFFFF",                     #-1
+  0b0001100: "{D}",                        #D
+  0b0110000: "{A}",                        #A
+  0b0001101: "~{D} & 0xFFFF",              #!D
+  0b0110001: "~{A} & 0xFFFF",              #!A
+  0b0001111: "-{D} & 0xFFFF",              #-D
+  0b0110011: "-{A} & 0xFFFF",              #-A
+  0b0011111: "{D}+1 & 0xFFFF",             #D+1
+  0b0110111: "{A}+1 & 0xFFFF",             #A+1
+  0b0001110: "{D}-1 & 0xFFFF",             #D-1
+  0b0110010: "{A}-1 & 0xFFFF",             #A-1
+  0b0000010: "{D}+{A} & 0xFFFF",           #D+A
+  0b0010011: "{D}-{A} & 0xFFFF",           #D-A
+  0b0000111: "{A}-{D} & 0xFFFF",           #A-D
+  0b0000000: "{D}&{A}",                    #D&A
+  0b0010101: "{D}|{A}",                    #D|A
+
+  0b1110000: "{M}",                        #M
+  0b1110001: "~{M} & 0xFFFF",              #!M
+  0b1110011: "-{M} & 0xFFFF",              #-M
+  0b1110111: "{M}+1 & 0xFFFF",             #M+1
+  0b1110010: "{M}-1 & 0xFFFF",             #M-1
+  0b1000010: "{D}+{M} & 0xFFFF",           #D+M
+  0b1010011: "{D}-{M} & 0xFFFF",           #D-M
+  0b1000111: "{M}-{D} & 0xFFFF",           #M-D
+  0b1000000: "{D}&{M}",                    #D&M
+  0b1010101: "{D}|{M}"                     #D|M
+}
+
+# the jump conditions as python expressions over the ALU output
+jumpExpr = {
+  0b001: "val and not val & 0x8000",       #JGT
+  0b010: "not val",                        #JEQ
+  0b011: "not val & 0x8000",               #JGE
+  0b100: "val & 0x8000",                   #JLT
+  0b101: "val",                            #JNE
+  0b110: "not val or val & 0x8000",        #JLE
+}
+
+handlers = {} # (instruction word, direct) => handler
+
+
+def handlerA(instr):
+  zr = 1 if instr==0 else 0
+  def handler(cpu):
+    cpu.PC+=1
+    cpu.registers[0]=instr
+    cpu.zr = zr
+    cpu.ng = 0 # the numbers here can't be negative as the first bit is always 0
+    return True
+  return handler
+
+
+# dest=comp;jump
+# same semantic as opcode_C.execute: M is written before A and the jump uses the new A
+# direct: for the cpus with a ram array (see hackCPU.ram)
+def handlerC(instr,direct=False):
+  dest = (instr >> 3) & 0x07
+  jump = (instr & 0x07)
+  comp = (instr >> 6) & 0x7F
+
+  src  = "def handler(cpu):\n"
+  src += "  r = cpu.registers\n"
+  src += "  val = " + compExpr[comp].format(A="r[0]",D="r[1]",M="cpu.ram[r[0] & 0x7FFF]" if direct else "cpu.fetchMemory(r[0])") + "\n"
+  src += "  cpu.zr = 0 if val else 1\n"
+  src += "  cpu.ng = 1 if val & 0x8000 else 0\n"
+  if dest & 0b001 and direct: # store into M, in the ram unless hooked
+    src += "  if cpu.setMemory is None: cpu.ram[r[0] & 0x7FFF] = val\n"
+    src += "  else: cpu.setMemory(r[0],val)\n"
+  elif dest & 0b001: # store into M
+    src += "  cpu.setMemory(r[0],val)\n"
+  if dest & 0b010: # store into D
+    src += "  r[1] = val\n"
+  if dest & 0b100: # store into A
+    src += "  r[0] = val\n"
+  if jump == 0b000:
+    src += "  cpu.PC += 1\n"
+  elif jump == 0b111:
+    src += "  cpu.PC = r[0]\n"
+  else:
+    src += f"  cpu.PC = r[0] if {jumpExpr[jump]} else cpu.PC+1\n"
+  src += "  return True\n"
+
+  scope = {}
+  exec(compile(src,f"<hack 0x{instr:04X}: {opcodes[1].getText(instr)}>","exec"),scope)
+  return scope["handler"]
+
+
+def getHandler(instr,direct=False):
+  handler = handlers.get((instr,direct))
+  if handler is None:
+    if not instr & 0x8000:
+      handler = handlerA(instr)
+    elif (instr >> 6) & 0x7F in compExpr:
+      handler = handlerC(instr,direct)
+    else: # unknown computation: let the generic opcode report it
+      handler = lambda cpu: opcodes[1].execute(cpu,instr)
+    handlers[(instr,direct)] = handler
+  return handler
+
+
+# placeholder for the not yet decoded addresses: decodes, caches and executes
+def decodeAt(cpu):
+  addr = cpu.PC & 0x7FFF
+  handler = getHandler(cpu.fetchInstruction(addr),cpu.ram is not None)
+  cpu.decoded[addr] = handler
+  return handler(cpu)
+
+
+"""
+Basic block translation
+
+A block is the straight-line run of instructions starting at an address and ending with the
+first instruction that has jump bits (or after maxBlock instructions). It is compiled into a
+single python function working on locals for A, D and PC, so the registers and the flags are
+written back to the cpu only once per block. Only the flags of the last instruction are kept,
+same as executing the instructions one by one.
+"""
+
+maxBlock = 64
+maxSpinBlocks = 4 # longest loop isSpinning follows
+
+
+def translateBlock(cpu,start):
+  src  = f"def block_{start:04X}(cpu):\n"
+  src += "  r = cpu.registers\n"
+  src += "  a = r[0]\n"
+  src += "  d = r[1]\n"
+  src += "  fetchMemory = cpu.fetchMemory\n"
+  src += "  setMemory = cpu.setMemory\n"
+  src += "  ram = cpu.ram\n"
+  direct = cpu.ram is not None
+
+  addr = start
+  count = 0
+  last = 0 # last translated instruction: its flags and its jump end the block
+  pure = True # no memory writes
+  while count < maxBlock and addr < 0x8000:
+    instr = cpu.fetchInstruction(addr)
+    if instr & 0x8000 and (instr >> 6) & 0x7F not in compExpr:
+      break # unknown computation: ends the block before it
+    addr+=1
+    count+=1
+    last = instr
+    if not instr & 0x8000:
+      src += f"  a = {instr} # @{instr}\n"
+      continue
+
+    dest = (instr >> 3) & 0x07
+    comp = (instr >> 6) & 0x7F
+    src += "  val = " + compExpr[comp].format(A="a",D="d",M="ram[a & 0x7FFF]" if direct else "fetchMemory(a)") + f" # {opcodes[1].getText(instr)}\n"
+    if dest & 0b001:
+      # a hooked write can raise (Simulator ROMError): the cpu is left as step() leaves it, on this instruction
+      sync = f"r[0] = a; r[1] = d; cpu.zr = 0 if val else 1; cpu.ng = 1 if val & 0x8000 else 0; cpu.PC = {addr-1}; "
+      if direct:
+        src += "  if setMemory is None: ram[a & 0x7FFF] = val\n"
+        src += f"  else: {sync}setMemory(a,val)\n"
+      else:
+        src += f"  {sync}setMemory(a,val)\n"
+      pure = False
+    if dest & 0b010:
+      src += "  d = val\n"
+    if dest & 0b100:
+      src += "  a = val\n"
+    if instr & 0x07:
+      break # a jump ends the block
+
+  if count == 0: # nothing to translate, let step() handle (and report) the instruction
+    block = lambda cpu: cpu.step()
+    block.end = start
+    block.pure = False
+    return block
+
+  src += "  r[0] = a\n"
+  src += "  r[1] = d\n"
+  if not last & 0x8000:
+    src += f"  cpu.zr = {1 if last==0 else 0}\n"
+    src += "  cpu.ng = 0\n"
+  else:
+    src += "  cpu.zr = 0 if val else 1\n"
+    src += "  cpu.ng = 1 if val & 0x8000 else 0\n"
+
+  jump = last & 0x07 if last & 0x8000 else 0
+  if jump == 0b000:
+    src += f"  cpu.PC = {addr}\n"
+  elif jump == 0b111:
+    src += "  cpu.PC = a\n"
+  else:
+    src += f"  cpu.PC = a if {jumpExpr[jump]} else {addr}\n"
+  src += f"  return {count}\n"
+
+  scope = {}
+  exec(compile(src,f"<hack block 0x{start:04X}>","exec"),scope)
+  block = scope[f"block_{start:04X}"]
+  block.end = addr-1 # last address inside the block
+  block.pure = pure
+  return block
+
+
 
 if __name__ == '__main__':
   mem = [0]*0x8000
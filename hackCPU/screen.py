@@ -12,8 +12,13 @@ each line is 32 bytes from top to bottom
 
 
 import threading
+from array import array
+
+import numpy as np
 import pygame
 
+from hackCPU.framebuffer import screenBits, screenView, screenWords
+
 # Set the screen dimensions
 screen_width = 512
 screen_height = 256
@@ -25,38 +30,50 @@ import sys
 
 
 class Screen:
-    def __init__(self, fetchMem, setMem,width=screen_width, height=screen_height):
+    def __init__(self, fetchMem, setMem,width=screen_width, height=screen_height, ram=None, dirty=None):
       self.fetchMem = fetchMem
       self.setMem = setMem
+      self.ram = ram # when given the screen words are read straight from it instead of through fetchMem
+      self.dirty = dirty # when given a bytearray of the rows written since the last frame (see setMemory in simulator-hack.py), else every row is redrawn
+                         # (or, for an array('H') ram, the rows that differ from the last frame)
+      self.frame = np.zeros((screen_width, screen_height), dtype=np.uint32) # colors of the last drawn frame
+      self.words = None # words of the last drawn frame, compared against an array('H') ram
       self.width = width
       self.height = height
       self.running = False  # Flag to control the rendering thread
       self.thread = None  # Thread object for rendering
 
     
+    # the pixels of the given screen rows as an array of 0/1 indexed [x,row] (the surfarray layout)
+    def pixels(self,rows=range(screen_height)):
+      if self.ram is not None:
+        words = screenWords(self.ram,rows)
+      else:
+        words = np.array([[self.fetchMem(16384+y*32+x) for x in range(32)] for y in rows], dtype=np.uint16).reshape(-1,32)
+      return screenBits(words).T
+
+    # draws the rows written since the last frame, returns False when nothing changed
     def refresh(self,screen):
-      # Create a surface to represent the monochrome screen
-      surface = pygame.Surface((screen_width, screen_height))
-
-      # Lock the surface for pixel access
-      surface.lock()
-
-      for y in range(256):
-        # Process each bit in the integer
-        for x in range(32):  # Each 16-bit integer represents 16 pixels
-            addr = 16384+y*32+x
-            val = self.fetchMem(addr)
-            for i in range(16):
-              bit = (val >> (i)) & 1  # Extract the x-th bit (LSB to MSB)
-              color = (255, 255, 255) if bit == 0 else (0, 0, 0)  # White for 1, Black for 0
-              # Set the pixel color on the surface
-              surface.set_at((x*16+i, y), color)
-
-      # Unlock the surface
-      surface.unlock()
-
-      # Blit the surface onto the screen
-      screen.blit(surface, (0, 0))
+      palette = np.array([screen.map_rgb((255,255,255)), screen.map_rgb((0,0,0))], dtype=np.uint32) # White for 0, Black for 1
+      if self.dirty is None and isinstance(self.ram,array):
+        words = screenView(self.ram).copy() # one copy, the cpu keeps writing meanwhile
+        rows = np.arange(screen_height) if self.words is None else np.flatnonzero((words != self.words).any(axis=1))
+        if len(rows) == 0:
+          return False
+        self.words = words
+        self.frame[:,rows] = palette[screenBits(words[rows]).T]
+        pygame.surfarray.blit_array(screen, self.frame)
+        return True
+
+      rows = range(screen_height)
+      if self.dirty is not None:
+        rows = np.flatnonzero(np.frombuffer(self.dirty, dtype=np.uint8))
+        if len(rows) == 0:
+          return False
+        self.dirty[:] = bytes(len(self.dirty)) # cleared before reading the ram so no write is lost
+      self.frame[:,rows] = palette[self.pixels(rows)]
+      pygame.surfarray.blit_array(screen, self.frame)
+      return True
 
     mapKeys={
         'space':32,
@@ -122,11 +139,9 @@ class Screen:
                     #print(f"Key released: {pygame.key.key_code(event.key)}")
                     self.setMem(24576, 0)
 
-            # Draw the monochrome screen
-            self.refresh(screen)
-
-            # Update the display
-            pygame.display.flip()
+            # Draw the monochrome screen and update the display, only when it changed
+            if self.refresh(screen):
+                pygame.display.flip()
 
             # Limit to 30 frames per second
             clock.tick(30)
@@ -154,7 +169,7 @@ class Screen:
 # Example Usage
 if __name__ == "__main__":
     mem = [0b1100110011110000]*0x7FFF
-    screen = Screen(mem)  # Create a screen object
+    screen = Screen(mem.__getitem__, mem.__setitem__, ram=mem)  # Create a screen object
 
     
     try:
@@ -164,7 +179,7 @@ if __name__ == "__main__":
         # Main thread can dynamically update pixel data
         while True:
             for i in range(0x7FFF):
-                mem[i] = ~mem[i]
+                mem[i] = ~mem[i] & 0xFFFF
             pass
     except KeyboardInterrupt:
         # Gracefully stop the screen when interrupted
@@ -0,0 +1,79 @@
+'''
+ Headless Hack Computer runner
+
+ Runs a .rom without pygame, debugger or throttling for a number of instructions
+ or until the program spins in a loop it can't leave without input (hackCPU.isSpinning):
+ its halt loop ((END) @END 0;JMP, Jack Sys.halt) or a keyboard wait
+ and dumps the screen every K instructions straight from the ram:
+   as PNG files: --png out/frame  writes out/frame00000.png, out/frame00001.png ...
+   as a raw monob stream: --raw frames.raw  (ffmpeg -f rawvideo -pix_fmt monob -s 512x256 -r 30 -i frames.raw out.mp4)
+ the last screen is always dumped
+
+ usage: python headless-hack.py program.rom [-n instructions] [-k every] [--png prefix] [--raw file]
+'''
+
+import argparse
+from array import array
+from time import perf_counter
+
+from hackCPU.framebuffer import frameBytes, savePNG
+from hackCPU.hackCPU import hackCPU
+from Simulator import Simulator
+from utils import loadMem
+
+
+def main():
+  parser = argparse.ArgumentParser(description="Runs a Hack .rom headless and dumps its screen")
+  parser.add_argument("rom")
+  parser.add_argument("-n","--instructions",type=int,default=10000000,help="instructions to run at most")
+  parser.add_argument("-k","--every",type=int,default=0,help="dump the screen every K instructions (0: only the last screen)")
+  parser.add_argument("--png",help="prefix of the PNG files")
+  parser.add_argument("--raw",help="file of the raw monob frame stream")
+  args = parser.parse_args()
+
+  ram = array('H',bytes(0x10000))  # 32K words of memory
+  rom = array('H',bytes(0x10000))  # 32K words of ROM
+  loadMem(rom,args.rom)
+
+  cpu = hackCPU(rom.__getitem__,ram.__getitem__,None,ram=ram)
+  simulator = Simulator(cpu,ram,None)
+  simulator.rom = rom
+  simulator.blockMode = True
+  cpu.reset()
+
+  raw = open(args.raw,"wb") if args.raw else None
+  frames = 0
+
+  def dump():
+    nonlocal frames
+    if args.png:
+      savePNG(ram,f"{args.png}{frames:05d}.png")
+    if raw:
+      raw.write(frameBytes(ram))
+    frames+=1
+
+  batch = args.every or simulator.batchSize
+  executed = 0
+  halted = False
+  start = perf_counter()
+  while executed < args.instructions:
+    count = min(batch,args.instructions-executed)
+    done = simulator.runFor(count)
+    executed += done
+    halted = cpu.isSpinning()
+    if args.every and (done == count or halted):
+      dump()
+    if halted or done < count:
+      break
+  elapsed = perf_counter()-start
+  if not args.every:
+    dump()
+  if raw:
+    raw.close()
+
+  state = "halted" if halted else "stopped"
+  print(f"{state} after {executed} instructions in {elapsed:.3f}s ({executed/elapsed:.0f} instr/s), {frames} frames {cpu.getRegisters()}")
+
+
+if __name__ == '__main__':
+  main()
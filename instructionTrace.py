@@ -0,0 +1,152 @@
+"""
+Binary instruction trace
+
+While the Simulator traces (Simulator.startTrace) every instruction appends one fixed size
+record to a preallocated ring buffer, a bytearray or a memory mapped file: the PC, the opcode,
+the registers before the instruction and, optionally, the last memory write it did.
+Nothing is formatted while running, the records are rendered afterwards with the decode()
+disassemblers of the cpu, from the Trace or from the file (also the in memory trace can be saved).
+The memory operands are not recorded: the values decode() shows for them are 0.
+
+The buffer starts with a header: magic, cpu class name, record size, capacity and the number
+of records written since the start (the last capacity of them are kept).
+
+usage: python instructionTrace.py file.trace [count]   (prints the last count records, all by default)
+"""
+
+import importlib
+import mmap
+import struct
+from sys import argv
+
+
+header = struct.Struct("<8s32sIIQ") # magic, cpu name, record size, capacity, records written
+magic = b"SIMTRC01"
+memoryWrite = "BHH" # appended to every record: 1 when the instruction wrote the memory, address, value
+noWrite = (0,0,0)
+
+
+# the cpu registers and the memory a record saw, standing for the cpu when decoding it
+class Replay:
+  def __init__(self,memory,**registers):
+    self.memory = memory # address => value, the opcode of the record
+    vars(self).update(registers)
+
+  def fetchMemory(self,address,peek=False):
+    return self.memory.get(address & 0xFFFF,0)
+
+  def fetchInstruction(self,address):
+    return self.memory.get(address & 0x7FFF,0)
+
+
+# the record layouts: struct format (without the memory write), capture of the cpu, replay of a record
+
+def capture6800(cpu):
+  pc = cpu.PC
+  fetch = cpu.fetchMemory
+  return (pc, fetch(pc,True), fetch((pc+1) & 0xFFFF,True), fetch((pc+2) & 0xFFFF,True), cpu.A, cpu.B, cpu.IX, cpu.SP, cpu.SR)
+
+def replay6800(pc,op0,op1,op2,a,b,ix,sp,sr):
+  return Replay({pc:op0, (pc+1) & 0xFFFF:op1, (pc+2) & 0xFFFF:op2}, PC=pc, A=a, B=b, IX=ix, SP=sp, SR=sr)
+
+def captureHack(cpu):
+  registers = cpu.registers
+  return (cpu.PC, cpu.fetchInstruction(cpu.PC & 0x7FFF), registers[0], registers[1], cpu.zr, cpu.ng)
+
+def replayHack(pc,instr,a,d,zr,ng):
+  return Replay({pc & 0x7FFF:instr}, PC=pc, registers=[a,d], zr=zr, ng=ng)
+
+layouts = { # cpu class name => (module, format, capture, replay)
+  "MC6800":          ("MC6800.MC6800", "<HBBBBBHHB", capture6800, replay6800),
+  "MC6800LazyFlags": ("MC6800.MC6800", "<HBBBBBHHB", capture6800, replay6800),
+  "hackCPU":         ("hackCPU.hackCPU", "<HHHHBB", captureHack, replayHack),
+}
+
+
+class Trace:
+  def __init__(self,cpuName,capacity=0x100000,fileName=None,buffer=None):
+    if cpuName not in layouts:
+      raise ValueError(f"no trace layout for the {cpuName} cpu")
+    self.cpuName = cpuName
+    self.module,format,self.capture,self.replay = layouts[cpuName]
+    self.record = struct.Struct(format + memoryWrite)
+    self.fields = len(struct.Struct(format).unpack(bytes(struct.calcsize(format))))
+    self.capacity = capacity
+    self.count = 0 # records written since the start, the next one goes at count % capacity
+    self.file = None
+    size = header.size + capacity * self.record.size
+    if buffer is not None: # load()
+      self.buffer = buffer
+      self.count = header.unpack_from(buffer)[4]
+    elif fileName is not None:
+      self.file = open(fileName,"w+b")
+      self.file.truncate(size)
+      self.buffer = mmap.mmap(self.file.fileno(),size)
+    else:
+      self.buffer = bytearray(size)
+    self.sync()
+
+  # writes the record count in the header (Simulator.runTraced does it after every batch)
+  def sync(self):
+    header.pack_into(self.buffer,0,magic,self.cpuName.encode(),self.record.size,self.capacity,self.count)
+
+  # closes the file, the records stay readable from a copy in memory
+  def close(self):
+    self.sync()
+    if self.file is not None:
+      mapped = self.buffer
+      self.buffer = bytearray(mapped)
+      mapped.close()
+      self.file.close()
+      self.file = None
+
+  def save(self,fileName):
+    self.sync()
+    with open(fileName,"wb") as f:
+      f.write(self.buffer)
+
+  @staticmethod
+  def load(fileName):
+    with open(fileName,"rb") as f:
+      data = bytearray(f.read())
+    tag,cpuName,size,capacity,count = header.unpack_from(data)
+    if tag != magic:
+      raise ValueError(f"{fileName} is not a trace")
+    trace = Trace(cpuName.rstrip(b"\0").decode(),capacity,buffer=data)
+    if trace.record.size != size:
+      raise ValueError(f"{fileName}: records of {size} bytes, expected {trace.record.size}")
+    return trace
+
+  # the records kept, oldest first: (registers and opcode fields, memory write or None)
+  # the last ones only, or the ones from record number first (counted since the start) to end
+  def records(self,last=None,first=0,end=None):
+    end = self.count if end is None else min(end,self.count)
+    first = max(first, self.count - self.capacity, 0)
+    if last is not None:
+      first = max(first, end - last)
+    for n in range(first,end):
+      values = self.record.unpack_from(self.buffer, header.size + (n % self.capacity) * self.record.size)
+      written,address,value = values[self.fields:]
+      yield values[:self.fields],(address,value) if written else None
+
+  # the records as text lines like the debugger shows them: registers, opcode, disassembly, memory write
+  def decode(self,last=None,first=0,end=None):
+    cpuClass = getattr(importlib.import_module(self.module),self.cpuName)
+    for values,write in self.records(last,first,end):
+      cpu = self.replay(*values)
+      o,instr = cpuClass.getOpcode(cpu,cpu.PC)
+      if o is None:
+        line = f"{cpuClass.getRegisters(cpu)}| |{cpu.fetchMemory(cpu.PC):02X}| unknown"
+      else:
+        opcodes = f"{instr:X}" if instr is not None else " ".join(f"{cpu.fetchMemory(cpu.PC+i):02X}" for i in range(o.length))
+        line = f"{cpuClass.getRegisters(cpu)}| |{opcodes:8s}| {o.decode(cpu,cpu.PC)}"
+      if write is not None:
+        line += f"  [{write[0]:04X}]={write[1]:X}"
+      yield line
+
+
+
+if __name__ == '__main__':
+  trace = Trace.load(argv[1])
+  for line in trace.decode(int(argv[2]) if len(argv)>2 else None):
+    print(line)
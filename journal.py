@@ -0,0 +1,66 @@
+"""
+Write journal for reverse execution
+
+While the Simulator journals, every memory write that changes the RAM stores its address and
+the old value in two preallocated arrays used as a ring buffer (no python object per write),
+and every interval instructions a checkpoint keeps the cpu registers and the devices.
+Going back in time undoes the writes down to the closest checkpoint before the target,
+restores its registers and runs forward again to the target instruction.
+How far back depends on size (writes) and on maxCheckpoints * interval (instructions).
+"""
+
+from array import array
+from collections import deque
+
+
+class Journal:
+  def __init__(self,size=0x40000,interval=1000,maxCheckpoints=1000):
+    self.size = size
+    self.addresses = array('l',[0]) * size
+    self.values = array('l',[0]) * size
+    self.writes = 0 # writes journaled since the start, the next one goes at writes % size
+    self.interval = interval # instructions between two checkpoints
+    self.checkpoints = deque(maxlen=maxCheckpoints) # (instructions, writes, cpu and devices state), oldest first
+    self.nextCheckpoint = 0 # instruction count of the next checkpoint
+
+  def record(self,address,old):
+    i = self.writes % self.size
+    self.addresses[i] = address
+    self.values[i] = old
+    self.writes += 1
+
+  def addCheckpoint(self,instructions,state):
+    self.prune()
+    self.checkpoints.append((instructions,self.writes,state))
+    self.nextCheckpoint = instructions + self.interval
+
+  # the checkpoints whose writes were overwritten in the ring can't be reached anymore
+  def prune(self):
+    while self.checkpoints and self.checkpoints[0][1] < self.writes - self.size:
+      self.checkpoints.popleft()
+
+  # the latest checkpoint at or before the instruction count, None when it is too far back
+  # the checkpoints after it are dropped, running forward again recreates them
+  def rewind(self,instructions):
+    self.prune()
+    if not self.checkpoints or self.checkpoints[0][0] > instructions:
+      return None
+    while self.checkpoints[-1][0] > instructions:
+      self.checkpoints.pop()
+    checkpoint = self.checkpoints[-1]
+    self.nextCheckpoint = checkpoint[0] + self.interval
+    return checkpoint
+
+  # writes back the old values, newest first, until only writes entries are left
+  def undo(self,writes,setMemory):
+    if writes < self.writes - self.size:
+      raise ValueError("the writes to undo were overwritten in the journal")
+    while self.writes > writes:
+      self.writes -= 1
+      i = self.writes % self.size
+      setMemory(self.addresses[i],self.values[i])
+
+  # oldest instruction count still reachable
+  def oldest(self):
+    self.prune()
+    return self.checkpoints[0][0] if self.checkpoints else None
@@ -0,0 +1,67 @@
+"""
+Copy-on-write paged memory
+
+A drop-in memory for the boards (instead of the bytearray of the 6802 board or the word
+lists of the hack board) made of fixed size pages. checkpoint() freezes the current pages
+and shares them: the next write to a shared page copies that page first, so a checkpoint
+or a restore costs one pointer per page and a forked run only pays for the pages it writes.
+Simulator.fork()/restore() use it to branch many runs from one machine state.
+"""
+
+from array import array
+
+
+class PagedMemory:
+  def __init__(self,size,pageSize=256,words=False):
+    self.size = size
+    self.pageSize = pageSize
+    self.shift = pageSize.bit_length()-1 # pageSize is a power of 2
+    self.mask = pageSize-1
+    self.words = words # 16 bit words (hack) in lists, else bytes in bytearrays
+    zero = [0] * pageSize if words else bytearray(pageSize)
+    self.pages = [zero] * (size // pageSize) # all sharing the zero page until written
+    self.owned = bytearray(len(self.pages)) # 1 for the pages only this memory uses
+
+  def __len__(self):
+    return self.size
+
+  def __getitem__(self,addr):
+    if type(addr) is slice:
+      values = [self[a] for a in range(*addr.indices(self.size))]
+      return values if self.words else bytearray(values)
+    return self.pages[addr >> self.shift][addr & self.mask]
+
+  def __setitem__(self,addr,value):
+    if type(addr) is slice:
+      for a,v in zip(range(*addr.indices(self.size)),value):
+        self[a] = v
+      return
+    p = addr >> self.shift
+    if not self.owned[p]: # shared: copy before writing
+      self.pages[p] = self.pages[p][:]
+      self.owned[p] = 1
+    self.pages[p][addr & self.mask] = value
+
+  def __iter__(self):
+    for page in self.pages:
+      yield from page
+
+  # the content as bytes (16 bit words for the word memories)
+  def tobytes(self):
+    if self.words:
+      return b"".join(array('H',page).tobytes() for page in self.pages)
+    return b"".join(self.pages)
+
+  # freezes the current content: returns the pages, which stay shared with this memory
+  def checkpoint(self):
+    self.owned = bytearray(len(self.pages))
+    return tuple(self.pages)
+
+  # continues from a checkpoint, the pages stay shared with it
+  def restore(self,pages):
+    self.pages[:] = pages
+    self.owned = bytearray(len(self.pages))
+
+  # number of pages written since the last checkpoint or restore
+  def pagesWritten(self):
+    return sum(self.owned)
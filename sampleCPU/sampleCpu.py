@@ -9,6 +9,7 @@
 
 
 class myCPU:
+    stateNames = ["PC","registers","CARRY","ZERO"] # saved by Simulator.snapshot
     
     def reset(self):
         self.PC = 0
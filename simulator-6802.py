@@ -1,4 +1,4 @@
-from MC6800.MC6800 import MC6800
+from MC6800.MC6800 import MC6800LazyFlags
 from debuggerSrv import Debugger
 from Simulator import Simulator
 from utils import loadHex
@@ -20,11 +20,12 @@ telnet = Telnet(ser.transmit,ser.receive)
 mem = bytearray(0xFFFF+1) # 64KB
 
 
-# initialize the CPU
-cpu = MC6800()
+# initialize the CPU (flags computed only when read)
+cpu = MC6800LazyFlags()
 
 #define the simulator board
 simulator = Simulator(cpu,mem,[ser])
+simulator.clock = 1000000 # run at the real 1MHz (0 for unthrottled)
 
 #hookup the debugger to the simulator board
 debugger = Debugger(simulator)
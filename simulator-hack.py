@@ -4,14 +4,16 @@
 '''
 
 
+from array import array
+
 from debuggerSrv import Debugger
 from hackCPU.hackCPU import hackCPU
 from hackCPU.screen import Screen
 from Simulator import Simulator
 from utils import loadMem
 
-ram = [0x0000] * 32768  # 32K words of memory
-rom = [0x0000] * 32768  # 32K words of ROM
+ram = array('H',bytes(0x10000))  # 32K words of memory, shared by the cpu, the screen and the debugger
+rom = array('H',bytes(0x10000))  # 32K words of ROM
 
 def fetchInstruction(address):
     return rom[address &0x7FFF]
@@ -22,15 +24,18 @@ def fetchMemory(address):
 def setMemory(address, value):
     ram[address & 0x7FFF] = value
 
-cpu = hackCPU(fetchInstruction,fetchMemory,setMemory)
+cpu = hackCPU(fetchInstruction,fetchMemory,None,ram=ram) # reads and writes the ram directly
 
 #define the simulator board
 simulator = Simulator(cpu,ram,None)
+simulator.rom = rom # saved by snapshots
+simulator.blockMode = True # run translated basic blocks, the debugger still single steps
+simulator.spinAction = "skip" # don't burn the host cpu on halt and keyboard wait loops
 
 #hookup the debugger to the simulator board
 debugger = Debugger(simulator)
 
-screen = Screen(fetchMemory,setMemory)  # Create a screen object
+screen = Screen(fetchMemory,setMemory,ram=ram)  # Create a screen object, drawn straight from the ram
 #Screen also implements keyboard
 
 
@@ -0,0 +1,76 @@
+import pathlib
+import random
+import sys
+import types
+
+sys.path.insert(0,str(pathlib.Path(__file__).resolve().parent.parent))
+
+from MC6800.MC6800 import MC6800, MC6800LazyFlags, opcodes
+
+
+# runs the specialized and the class execute of every opcode on the same pseudo random
+# machine states (the same ones for a given seed) and reports the opcodes where they differ
+def checkSpecialized(trials=100,seed=6800):
+    rnd = random.Random(seed)
+    failed = []
+    for op in opcodes:
+        for t in range(trials):
+            mem = bytearray(rnd.randbytes(0x10000))
+            mem[0xFFFE] = 0
+            regs = {"PC":rnd.randrange(0xFFF0), "A":rnd.randrange(256), "B":rnd.randrange(256),
+                    "IX":rnd.randrange(0xFFF0), "SP":rnd.randrange(8,0xFFF0), "SR":rnd.randrange(256) | 0xC0}
+            results = []
+            for execute in [op.execute, types.MethodType(type(op).execute,op)]:
+                m = bytearray(mem)
+                cpu = MC6800(lambda addr,peek=False: m[addr & 0xFFFF], lambda addr,val: m.__setitem__(addr & 0xFFFF,val & 0xFF))
+                for reg,val in regs.items():
+                    setattr(cpu,reg,val)
+                try:
+                    ret = execute(cpu)
+                    results.append((ret,cpu.getRegisters(),bytes(m)))
+                except Exception as e:
+                    results.append(type(e))
+            if results[0] != results[1]:
+                failed.append(op)
+                break
+    return failed
+
+
+# the specialized execute of every opcode does what the execute of its class does
+def test_specialized_handlers():
+    failed = checkSpecialized(trials=20)
+    assert failed == [], [f"{op.code:02X} {op.text} {op.type}" for op in failed]
+
+
+def test_cycle_table():
+    assert [op.text for op in opcodes if op.cycles == 0] == []
+
+
+# runs MC6800 and MC6800LazyFlags from the same pseudo random machine state and compares the
+# registers after every instruction (SR only at the end: reading it computes the pending flags)
+# and the memory at the end. The memory only holds opcodes, wherever the branches and jumps go
+# they find an instruction to run (the operands are opcodes too)
+def test_lazy_flags():
+    rnd = random.Random(6802)
+    codes = [op.code for op in opcodes if op.text != "WAI"]
+    edges = [0x00,0x01,0x7F,0x80,0xFF] # the values the flags depend on
+    for t in range(500):
+        mem = bytearray(rnd.choices(codes,k=0x10000))
+        regs = {"PC":rnd.randrange(0x10000), "A":rnd.choice(edges), "B":rnd.choice(edges),
+                "IX":rnd.randrange(0x10000), "SP":rnd.randrange(0x10000), "SR":rnd.randrange(256) | 0xC0}
+        results = []
+        for cls in [MC6800, MC6800LazyFlags]:
+            m = bytearray(mem)
+            cpu = cls(lambda addr,peek=False: m[addr & 0xFFFF], lambda addr,val: m.__setitem__(addr & 0xFFFF,val & 0xFF))
+            for reg,val in regs.items():
+                setattr(cpu,reg,val)
+            steps = []
+            try:
+                for i in range(256):
+                    cpu.step()
+                    steps.append((cpu.PC,cpu.A,cpu.B,cpu.IX,cpu.SP,cpu.cycles))
+            except Exception as e: # both stop on the same instruction
+                steps.append(type(e))
+            results.append((steps,cpu.getRegisters(),bytes(m)))
+        assert results[0][:2] == results[1][:2], f"trial {t}"
+        assert results[0][2] == results[1][2], f"trial {t}: memory differs"
@@ -0,0 +1,42 @@
+import array
+import pathlib
+import random
+import sys
+
+sys.path.insert(0,str(pathlib.Path(__file__).resolve().parent.parent))
+
+from hackCPU.hackCPU import ALU, getHandler, hackCPU, opcodes
+
+edges = [0,1,0x7FFF,0x8000,0xFFFF] # the values the flags and the jumps depend on
+
+
+# a cpu on its own ROM and RAM, with the RAM indexed directly (direct) or through fetchMemory/setMemory
+def newCPU(rom,ram,direct):
+  if direct:
+    return hackCPU(rom.__getitem__,None,None,ram)
+  return hackCPU(rom.__getitem__,lambda addr: ram[addr & 0x7FFF],lambda addr,val: ram.__setitem__(addr & 0x7FFF,val))
+
+
+def state(cpu,ram):
+  return (cpu.PC,cpu.registers,int(cpu.zr),int(cpu.ng),bytes(ram))
+
+
+# the decoded handler of every instruction does what the opcode execute does
+def test_decoded_handlers():
+  rnd = random.Random(0x8000)
+  rom = [0]*0x8000
+  for instr in [rnd.randrange(0x8000) for i in range(200)] + [i for i in range(0x8000,0x10000) if (i >> 6) & 0x7F in ALU]:
+    ram = array.array("H",[rnd.choice(edges+[rnd.randrange(0x10000)]) for i in range(0x8000)])
+    regs = [rnd.choice(edges+[rnd.randrange(0x8000)]),rnd.choice(edges+[rnd.randrange(0x10000)])]
+    results = []
+    for direct in [None,False,True]: # None: the opcode execute
+      m = array.array("H",ram)
+      cpu = newCPU(rom,m,direct)
+      cpu.registers = regs[:]
+      cpu.PC = 100
+      if direct is None:
+        opcodes[1 if instr & 0x8000 else 0].execute(cpu,instr)
+      else:
+        getHandler(instr,direct)(cpu)
+      results.append(state(cpu,m))
+    assert results[0] == results[1] == results[2], f"{instr:04X} {opcodes[1].getText(instr)}"